@@ -0,0 +1,140 @@
+classdef MFGPClient < handle
+    %MFGPClient:
+    %   Object to talk to a persistent MFGP server (mfgp/mfgp_server.py)
+    %   over a local TCP socket instead of calling mfgp_matlab through the
+    %   py.* bridge. Arrays are sent as rows (uint32), cols (uint32) and
+    %   row-major float64 data, all little-endian.
+
+    properties
+        % static configurations
+        Host;       % address of the MFGP server
+        Port;       % port of the MFGP server
+
+        % dynamic attributes
+        Connection; % tcpclient object connected to the server
+    end
+
+    properties (Constant)
+        UPDATE_L = 1;
+        UPDATE_H = 2;
+        PREDICT = 3;
+        GET_HYP = 4;
+        SET_HYP = 5;
+        RETRAIN = 6;
+        APPEND_L = 7;
+        APPEND_H = 8;
+        SHUTDOWN = 255;
+    end
+
+    methods
+        function obj = MFGPClient(port)
+            %MFGPClient:
+            %   Connect to an MFGP server on the local machine
+            if nargin < 1
+                port = 5005;
+            end
+            obj.Host = '127.0.0.1';
+            obj.Port = port;
+            obj.Connection = tcpclient(obj.Host, obj.Port);
+        end
+
+        function UpdateL(obj, X_L, y_L)
+            %UpdateL:
+            %   Replace the low fidelity training data
+            obj.Request(obj.UPDATE_L, {X_L, y_L});
+        end
+
+        function UpdateH(obj, X_H, y_H)
+            %UpdateH:
+            %   Replace the high fidelity training data
+            obj.Request(obj.UPDATE_H, {X_H, y_H});
+        end
+
+        function AppendL(obj, X_new, y_new)
+            %AppendL:
+            %   Send only new low fidelity rows; the server extends its
+            %   factorization instead of refitting the whole history
+            obj.Request(obj.APPEND_L, {X_new, y_new});
+        end
+
+        function AppendH(obj, X_new, y_new)
+            %AppendH:
+            %   Send only new high fidelity rows
+            obj.Request(obj.APPEND_H, {X_new, y_new});
+        end
+
+        function [mu, s2] = Predict(obj, X_star)
+            %Predict:
+            %   Posterior mean and variance at the test points X_star, as
+            %   row vectors
+            result = obj.Request(obj.PREDICT, {X_star});
+            mu = result{1};
+            s2 = result{2};
+        end
+
+        function hyp = GetHyp(obj)
+            %GetHyp:
+            %   Current (log) hyperparameters of the model
+            result = obj.Request(obj.GET_HYP, {});
+            hyp = result{1};
+        end
+
+        function SetHyp(obj, hyp)
+            %SetHyp:
+            %   Set the (log) hyperparameters and refactor the model
+            obj.Request(obj.SET_HYP, {hyp});
+        end
+
+        function nlml = Retrain(obj, max_iters, time_budget_s)
+            %Retrain:
+            %   Warm-started, time-bounded refit of the hyperparameters;
+            %   returns the NLML before and after
+            result = obj.Request(obj.RETRAIN, {[max_iters, time_budget_s]});
+            nlml = result{1};
+        end
+
+        function Shutdown(obj)
+            %Shutdown:
+            %   Stop the server process
+            obj.Request(obj.SHUTDOWN, {});
+            obj.Connection = [];
+        end
+
+        function result = Request(obj, code, arrays)
+            %Request:
+            %   Send one framed request and read back the response arrays
+            message = uint8([code, numel(arrays)]);
+            for i = 1:numel(arrays)
+                message = [message, MFGPClient.EncodeArray(arrays{i})]; %#ok<AGROW>
+            end
+            write(obj.Connection, message);
+
+            header = read(obj.Connection, 2, 'uint8');
+            result = cell(1, double(header(2)));
+            for i = 1:numel(result)
+                shape = double(typecast(read(obj.Connection, 8, 'uint8'), 'uint32'));
+                n = shape(1) * shape(2);
+                data = zeros(1, n);
+                if n > 0
+                    data = typecast(read(obj.Connection, 8 * n, 'uint8'), 'double');
+                end
+                result{i} = reshape(data, shape(2), shape(1))';
+            end
+
+            if header(1) ~= 0
+                error("MFGP server: %s", char(result{1}));
+            end
+        end
+    end
+
+    methods (Static)
+        function bytes = EncodeArray(array)
+            %EncodeArray:
+            %   Frame a 2D double array as shape header plus row-major data
+            array = double(array);
+            shape = typecast(uint32(size(array)), 'uint8');
+            data = typecast(reshape(array', 1, []), 'uint8');
+            bytes = [shape, data];
+        end
+    end
+end
@@ -398,7 +398,7 @@ classdef HILGPC_Data < handle
            % Predict using model
            % TestPoints is X_star
            X_star = obj.TestPoints;
-           result = mfgp_matlab.predict_MFGP(obj.Model, X_star);
+           result = mfgp_matlab.predict_MFGP_chunked(obj.Model, X_star);
            mu = double(result{1})';
            var = double(result{2})';
            hyp = exp(double(obj.Model.hyp))
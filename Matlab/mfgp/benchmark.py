@@ -0,0 +1,156 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Headless timings of Multifidelity_GP on the synthetic f_L / f_H of
+mf2Dtest, over a sweep of the number of training points N (half low, half
+high fidelity), the number of test points M and the input dimension D
+(f_L and f_H only read the first two inputs, so D >= 2). For every (N, D)
+it times the likelihood, its value and gradient (objective), a full
+updt_info, an append of a few rows, predict with and without the full
+covariance for every M, get_max_var for every grid budget G (the grid
+scores grid_size(D, G, G) ** D <= G points, which is the M recorded) and,
+for N up to --train-max-n, train. Each time is the best of --repeats
+runs; predict starts without cached distance blocks on every run.
+
+Results are printed and written as JSON and/or CSV records tagged with the
+current git commit, for tracking across commits.
+
+Run with: python benchmark.py [--n 100 200] [--m 400 1600] [--d 2 3]
+                              [--grid 625 2500] [--json out.json]
+                              [--csv out.csv]
+"""
+
+from __future__ import division, print_function
+import argparse
+import csv
+import json
+import os
+import subprocess
+import time
+import numpy
+from pyDOE import lhs
+from gaussian_process import Multifidelity_GP, grid_size
+from mf2Dtest import f_L, f_H
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIELDS = ['commit', 'op', 'D', 'N', 'M', 'seconds']
+
+# Threshold and confidence of the first round in mf2Dtest
+THRD = 39
+C = numpy.sqrt(2 * numpy.log(1 / 0.05))
+# Rows appended by the append benchmark
+N_APPEND = 10
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD'], cwd=HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def best_time(fn, repeats, setup=None):
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+# Model on N points of f_L and f_H over [-3, 3]^D, with the default
+# hyper-parameters
+def make_model(N, D, seed=0):
+    numpy.random.seed(seed)
+    lb = -3. * numpy.ones(D)
+    ub = 3. * numpy.ones(D)
+    X_L = lb + (ub - lb) * lhs(D, N - N // 2)
+    X_H = lb + (ub - lb) * lhs(D, N // 2)
+    model = Multifidelity_GP(X_L, f_L(X_L), X_H, f_H(X_H))
+    model.updt_info(model.X_L, model.y_L, model.X_H, model.y_H)
+    return model, (lb, ub)
+
+
+def run(Ns, Ms, Gs, Ds, repeats=3, train_max_n=200):
+    commit = git_commit()
+    records = []
+
+    def record(op, D, N, M, seconds):
+        records.append({'commit': commit, 'op': op, 'D': D, 'N': N, 'M': M,
+                        'seconds': seconds})
+        print("%-13s D=%d N=%5d M=%6d %10.4f s" % (op, D, N, M, seconds))
+
+    for D in Ds:
+        for N in Ns:
+            model, (lb, ub) = make_model(N, D)
+            X_L, y_L = model.X_L, model.y_L
+            X_H, y_H = model.X_H, model.y_H
+            hyp = numpy.array(model.hyp)
+
+            record('likelihood', D, N, 0,
+                   best_time(lambda: model.likelihood(hyp), repeats))
+            record('objective', D, N, 0,
+                   best_time(lambda: model.objective(hyp), repeats))
+            record('updt_info', D, N, 0, best_time(
+                lambda: model.updt_info(X_L, y_L, X_H, y_H,
+                                        incremental=False), repeats))
+
+            def drop_last():
+                model.updt_info(X_L[:-N_APPEND], y_L[:-N_APPEND], X_H, y_H)
+            record('append', D, N, N_APPEND, best_time(
+                lambda: model.append(X_L[-N_APPEND:], y_L[-N_APPEND:],
+                                     X_H[:0], y_H[:0]),
+                repeats, drop_last))
+
+            def clear_dists():
+                model.dists = []
+            model.posterior()
+            for M in Ms:
+                X_star = lb + (ub - lb) * lhs(D, M)
+                record('predict_diag', D, N, M, best_time(
+                    lambda: model.predict(X_star, full_cov=False), repeats,
+                    clear_dists))
+                record('predict_full', D, N, M, best_time(
+                    lambda: model.predict(X_star, full_cov=True), repeats,
+                    clear_dists))
+
+            empty = numpy.empty([0, D])
+            for G in Gs:
+                record('get_max_var', D, N, grid_size(D, G, G) ** D,
+                       best_time(lambda: model.get_max_var(
+                           (lb, ub), THRD, C, empty, empty, n_grid=G,
+                           max_points=G), repeats))
+
+            if N <= train_max_n:
+                record('train', D, N, 0, best_time(model.train, 1))
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--n', type=int, nargs='+', default=[100, 200, 400,
+                                                            800])
+    parser.add_argument('--m', type=int, nargs='+', default=[400, 1600,
+                                                            6400])
+    parser.add_argument('--grid', type=int, nargs='+', default=[625, 2500,
+                                                               10000])
+    parser.add_argument('--d', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--train-max-n', type=int, default=200)
+    parser.add_argument('--json')
+    parser.add_argument('--csv')
+    args = parser.parse_args()
+
+    records = run(args.n, args.m, args.grid, args.d, args.repeats,
+                  args.train_max_n)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(records, f, indent=1)
+    if args.csv:
+        with open(args.csv, 'w') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
@@ -6,45 +6,282 @@ Created on Sat May 20 20:56:05 2017
 @author: Paris
 """
 from __future__ import division
+import struct
+import time
+import threading
+import zipfile
+import numpy
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import autograd.numpy as np
 from autograd import value_and_grad
+from pyDOE import lhs
 from scipy.optimize import minimize
+from autograd.scipy.linalg import solve_triangular
+from scipy.linalg import cho_solve
 from scipy.stats import norm
 from scipy.optimize import differential_evolution
+from kernels import RBF, dist_nbytes
+
+
+# Extends the lower Cholesky factor L of K with k new rows/columns inserted
+# at position p. K_pre (k x p) and K_post (n-p x k) hold the covariances of
+# the new points with the points before and after p, K_new (k x k) their own
+# block. Costs O(n^2 k), the trailing block being downdated by the new
+# columns (see chol_downdate) rather than refactored.
+def chol_insert(L, p, K_pre, K_new, K_post):
+    n = L.shape[0]
+    k = K_new.shape[0]
+    L_AA = L[:p, :p]
+    L_CA = L[p:, :p]
+    L_CC = L[p:, p:]
+
+    L_BA = solve_triangular(L_AA, K_pre.T, lower=True).T
+    L_BB = np.linalg.cholesky(K_new - np.matmul(L_BA, L_BA.T))
+
+    L_out = np.zeros((n + k, n + k))
+    L_out[:p, :p] = L_AA
+    L_out[p:p + k, :p] = L_BA
+    L_out[p:p + k, p:p + k] = L_BB
+    if p < n:
+        L_CB = solve_triangular(L_BB, (K_post - np.matmul(L_CA, L_BA.T)).T,
+                                lower=True).T
+        L_out[p + k:, :p] = L_CA
+        L_out[p + k:, p:p + k] = L_CB
+        L_out[p + k:, p + k:] = chol_downdate(L_CC, L_CB)
+    return L_out
+
+
+# Lower Cholesky factor of L L^T - X X^T for an n x k matrix X, in O(n^2 k).
+# Column j of [L X] is reduced to [r 0] by a hyperbolic Householder
+# reflection, which keeps L L^T - X X^T unchanged; raises LinAlgError if the
+# downdated matrix is not positive definite.
+def chol_downdate(L, X):
+    L = numpy.array(L)
+    X = numpy.array(X)
+    for j in range(L.shape[0]):
+        x = X[j]
+        xx = numpy.dot(x, x)
+        if xx == 0:
+            continue
+        l = L[j, j]
+        if xx >= l * l:
+            raise numpy.linalg.LinAlgError(
+                "Downdated matrix is not positive definite")
+        r = numpy.sqrt(l * l - xx)
+        # Reflector vector u = [l - r, -x], with l - r free of cancellation
+        delta = xx / (l + r)
+        beta = 2. / (delta * delta - xx)
+        Bu = delta * L[j:, j] - numpy.dot(X[j:], x)
+        L[j:, j] -= beta * delta * Bu
+        X[j:] -= beta * numpy.outer(Bu, x)
+        L[j, j] = r
+        X[j] = 0.
+    return L
+
+
+# Guards the distance caches of the models against predict_parallel threads
+dist_lock = threading.Lock()
+
+
+# Raised from inside the optimizer when a retrain runs out of time
+class BudgetExceeded(Exception):
+    pass
+
+
+# Runs one L-BFGS-B fit of model's hyper-parameters from hyp0 and reports
+# how it went. Kept at module level so restarts can go to a process pool.
+def train_restart(model, hyp0, callback=False):
+    start = time.time()
+    try:
+        result = minimize(model.objective, hyp0, jac=True, method='L-BFGS-B',
+                          callback=model.callback if callback else None)
+        hyp, nlml, nit, success = result.x, result.fun, result.nit, \
+                                  result.success
+    except np.linalg.LinAlgError:
+        hyp, nlml, nit, success = hyp0, np.inf, 0, False
+    return {'hyp0': hyp0, 'hyp': hyp, 'nlml': float(nlml), 'nit': nit,
+            'success': success, 'time': time.time() - start}
+
+
+# True if X_new holds all rows of X_old followed by zero or more new rows
+def is_appended(X_old, X_new):
+    n = X_old.shape[0]
+    return X_new.shape[0] >= n and np.array_equal(X_new[:n], X_old)
+
+
+# Version of the layout written by Multifidelity_GP.save
+SNAPSHOT_VERSION = 1
+
+
+# Arrays of an .npz file by name. With mmap the arrays np.savez stored
+# uncompressed are memory-mapped in place rather than read: the local zip
+# header of each member is skipped to the .npy header, which gives the
+# offset, type and shape of the raw data.
+def load_npz(path, mmap=True):
+    arrays = {}
+    with numpy.load(path) as npz, open(path, 'rb') as f, \
+            zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = npz[name]
+                continue
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            if numpy.lib.format.read_magic(f) == (1, 0):
+                header = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                header = numpy.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            if dtype.hasobject or numpy.prod(shape) == 0 or shape == ():
+                arrays[name] = npz[name]
+                continue
+            arrays[name] = numpy.asarray(numpy.memmap(
+                path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                order='F' if fortran_order else 'C'))
+    return arrays
+
+
+# Points per dimension of a grid over D dimensions: n_grid, lowered so the
+# grid has at most max_points points in all
+def grid_size(D, n_grid, max_points):
+    n = int(np.floor(max_points ** (1. / D) + 1e-9))
+    return max(min(n_grid, n), 1)
+
+
+# Maximizes the post-fantasy variance of model over the box Bounds, with
+# args passed on to model.get_neg_var and model.get_neg_var_batch.
+# method='grid' scores a dense grid of n_grid points per dimension (fewer
+# if the grid would exceed max_points, see grid_size) in batches of
+# chunk_size and refines the best one with L-BFGS-B. Where that leaves
+# fewer than 3 points per dimension it falls back to 'de_batch', which
+# runs differential_evolution on whole populations; method='de' is the
+# original one-candidate-at-a-time search. Evaluation counts, rates and
+# the method used are left in model.acq_stats.
+def max_neg_var(model, Bounds, args, method='grid', n_grid=50,
+                chunk_size=2048, max_points=2500):
+    Bounds = [(lb, ub) for lb, ub in zip(Bounds[0], Bounds[1])]
+    start = time.time()
+    if method == 'grid':
+        n_grid = grid_size(len(Bounds), n_grid, max_points)
+        if n_grid < 3:
+            method = 'de_batch'
+
+    if method == 'de':
+        result = differential_evolution(model.get_neg_var, Bounds,
+                                        args=args, init='random')
+        x, fun, nfev = result.x, result.fun, result.nfev
+    elif method == 'de_batch':
+        evals = [0]
+
+        def neg_var(X):
+            evals[0] += X.shape[1]
+            return model.get_neg_var_batch(X.T, *args)
+        result = differential_evolution(neg_var, Bounds, init='random',
+                                        vectorized=True,
+                                        updating='deferred')
+        x, fun, nfev = result.x, result.fun, evals[0]
+    elif method == 'grid':
+        axes = [np.linspace(lb, ub, n_grid) for lb, ub in Bounds]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+        grid = grid.reshape(-1, len(Bounds))
+        neg_var = np.concatenate(
+            [model.get_neg_var_batch(grid[i:i + chunk_size], *args)
+             for i in range(0, grid.shape[0], chunk_size)])
+        best = np.argmin(neg_var)
+        x, fun, nfev = grid[best], neg_var[best], grid.shape[0]
+        if fun < 0:
+            result = minimize(model.get_neg_var, x, args=args,
+                              method='L-BFGS-B', bounds=Bounds)
+            nfev += result.nfev
+            if result.fun < fun:
+                x, fun = result.x, result.fun
+    else:
+        raise ValueError("Unknown method: %s" % method)
+
+    elapsed = time.time() - start
+    model.acq_stats = {'method': method, 'evals': nfev, 'time': elapsed,
+                       'evals_per_s': nfev / max(elapsed, 1e-12)}
+    return x[None, :], -fun
+
+
+# Yields (start, mean, var) of model.predict over consecutive blocks of
+# chunk_size test points, with marginal variances only, so memory stays
+# bounded by the block size rather than the number of test points. kwargs
+# are passed on to predict.
+def predict_blocks(model, X_star, chunk_size, **kwargs):
+    for start in range(0, X_star.shape[0], chunk_size):
+        pred_u_star, var_u_star = model.predict(
+            X_star[start:start + chunk_size], full_cov=False, **kwargs)
+        yield start, pred_u_star, var_u_star
+
+
+# Prints the negative log-marginal likelihood of model at a training step
+def print_likelihood(model):
+    print("Log likelihood {}".format(model.last_nlml))
+
+
+# Negative post-fantasy variance of model at the candidate x given the
+# pending points X_new (passed on to model.pred_var), or 0 where the
+# candidate is gated out by mean + c * var <= thrd
+def neg_var(model, x, thrd, c, X_new):
+    x = x[None, :]
+    mean, var_old = model.predict(x, full_cov=False)
+    if mean + c * var_old <= thrd:
+        return 0
+    # elif mean - c * var_old >= thrd:
+    #     return 0
+    else:
+        var = model.pred_var(x, *X_new, full_cov=False)
+        return -var[0, 0]
+
+
+# Vectorized neg_var over a batch of candidates X (n x D)
+def neg_var_batch(model, X, thrd, c, X_new):
+    mean, var_old = model.predict(X, full_cov=False)
+    var = model.pred_var(X, *X_new, full_cov=False)
+    score = np.where(mean + c * var_old <= thrd, 0., -var)
+    return score[:, 0]
 
 
 # A minimal Gaussian process class
 class GP:
     # Initialize the class
-    def __init__(self, X, y):
+    def __init__(self, X, y, kernel=None):
         self.D = X.shape[1]
         self.X = X
         self.y = y
-        
+        # Covariance function from kernels, isotropic RBF by default
+        self.kern = RBF(self.D) if kernel is None else kernel
 
         self.hyp = self.init_params()
 
         self.jitter = 1e-8
+        # Row block size of kernel evaluations, None for a single block
+        self.chunk_size = None
+        # Posterior products keyed to the (L, y, hyp) they were computed from
+        self.cache = None
 
         self.likelihood(self.hyp)
         print("Total number of parameters: %d" % (self.hyp.shape[0]))
 
     # Initialize hyper-parameters
     def init_params(self):
-        hyp = np.log(np.ones(self.D + 1))
+        hyp = np.log(np.ones(self.kern.n_params))
         self.idx_theta = np.arange(hyp.shape[0])
         logsigma_n = np.array([-4.0])
         hyp = np.concatenate([hyp, logsigma_n])
         return hyp
 
-    # A simple vectorized rbf kernel
+    # Kernel matrix between the rows of x and xp
     def kernel(self, x, xp, hyp):
-        output_scale = np.exp(hyp[0])
-        lengthscales = np.exp(hyp[1])
-        print(lengthscales)
-        diffs = np.expand_dims(x / lengthscales, 1) - \
-                np.expand_dims(xp / lengthscales, 0)
-        return output_scale * np.exp(-0.5 * np.sum(diffs ** 2, axis=2))
+        return self.kern(x, xp, hyp, self.chunk_size)
+
+    # Diagonal of kernel(x, x, hyp) as a column vector
+    def kernel_diag(self, x, hyp):
+        return self.kern.diag(x, hyp)
 
     # Computes the negative log-marginal likelihood
     def likelihood(self, hyp):
@@ -62,21 +299,44 @@ class GP:
         L = np.linalg.cholesky(K + np.eye(N) * self.jitter)
         self.L = L
 
-        alpha = np.linalg.solve(np.transpose(L), np.linalg.solve(L, y))
-        NLML = 0.5 * np.matmul(np.transpose(y), alpha) + \
+        Linv_y = solve_triangular(L, y, lower=True)
+        NLML = 0.5 * np.sum(Linv_y ** 2) + \
                np.sum(np.log(np.diag(L))) + 0.5 * np.log(2. * np.pi) * N
-        return NLML[0, 0]
+        return NLML
 
     # Minimizes the negative log-marginal likelihood
     def train(self):
-        result = minimize(value_and_grad(self.likelihood), self.hyp, jac=True,
+        result = minimize(self.objective, self.hyp, jac=True,
                           method='L-BFGS-B', callback=self.callback)
         self.hyp = result.x
+        self.likelihood(self.hyp)
 
-    # Return posterior mean and variance at a set of test points
-    def predict(self, X_star):
+    # Negative log-marginal likelihood and its gradient. The value is kept
+    # for the callback so it does not have to evaluate the likelihood again.
+    def objective(self, hyp):
+        nlml, grad = value_and_grad(self.likelihood)(hyp)
+        self.last_nlml = nlml
+        return nlml, grad
+
+    # Returns the whitened targets L^-1 y and alpha = K^-1 y, recomputed only
+    # when the factor, the targets or the hyper-parameters have changed
+    def posterior(self):
+        cache = self.cache
+        if cache is None or cache['L'] is not self.L or \
+                cache['y'] is not self.y or \
+                not np.array_equal(cache['hyp'], self.hyp):
+            Linv_y = solve_triangular(self.L, self.y, lower=True)
+            alpha = solve_triangular(self.L.T, Linv_y, lower=False)
+            cache = {'L': self.L, 'y': self.y, 'hyp': np.array(self.hyp),
+                     'Linv_y': Linv_y, 'alpha': alpha}
+            self.cache = cache
+        return cache['Linv_y'], cache['alpha']
+
+    # Return posterior mean and variance at a set of test points. With
+    # full_cov=False only the marginal variances are computed and returned
+    # as a column vector, without forming the N* x N* covariance.
+    def predict(self, X_star, full_cov=True):
         X = self.X
-        y = self.y
 
         L = self.L
 
@@ -84,30 +344,30 @@ class GP:
 
         psi = self.kernel(X_star, X, theta)
 
-        alpha = np.linalg.solve(np.transpose(L), np.linalg.solve(L, y))
+        _, alpha = self.posterior()
         pred_u_star = np.matmul(psi, alpha)
 
-        beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L, psi.T))
-        var_u_star = self.kernel(X_star, X_star, theta) - np.matmul(psi, beta)
+        v = solve_triangular(L, psi.T, lower=True)
+        if not full_cov:
+            var_u_star = self.kernel_diag(X_star, theta) - \
+                         np.sum(v ** 2, axis=0)[:, None]
+            return pred_u_star, var_u_star
+
+        var_u_star = self.kernel(X_star, X_star, theta) - np.matmul(v.T, v)
 
         return pred_u_star, var_u_star
 
+    # Yields (start, mean, var) over consecutive blocks of chunk_size test
+    # points, with marginal variances only, so memory stays bounded by the
+    # block size rather than the number of test points
+    def predict_iter(self, X_star, chunk_size=4096):
+        return predict_blocks(self, X_star, chunk_size)
+
     def ExpectedImprovement(self, X_star):
-        X = self.X
         y = self.y
 
-        L = self.L
-
-        theta = self.hyp[self.idx_theta]
-
-        psi = self.kernel(X_star, X, theta)
-
-        alpha = np.linalg.solve(np.transpose(L), np.linalg.solve(L, y))
-        pred_u_star = np.matmul(psi, alpha)
-
-        beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L, psi.T))
-        var_u_star = self.kernel(X_star, X_star, theta) - np.matmul(psi, beta)
-        var_u_star = np.abs(np.diag(var_u_star))[:, None]
+        pred_u_star, var_u_star = self.predict(X_star, full_cov=False)
+        var_u_star = np.abs(var_u_star)
 
         # Expected Improvement
         best = np.min(y)
@@ -123,48 +383,63 @@ class GP:
         return np.random.multivariate_normal(np.zeros(N), K, N_samples).T
 
     def draw_posterior_samples(self, X_star, N_samples=1):
-        X = self.X
-        y = self.y
-
-        L = self.L
-
-        theta = self.hyp[self.idx_theta]
-
-        psi = self.kernel(X_star, X, theta)
-
-        alpha = np.linalg.solve(np.transpose(L), np.linalg.solve(L, y))
-        pred_u_star = np.matmul(psi, alpha)
-
-        beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L, psi.T))
-        var_u_star = self.kernel(X_star, X_star, theta) - np.matmul(psi, beta)
+        pred_u_star, var_u_star = self.predict(X_star)
 
         return np.random.multivariate_normal(pred_u_star.flatten(),
                                              var_u_star, N_samples).T
 
     #  Prints the negative log-marginal likelihood at each training step
     def callback(self, params):
-        print("Log likelihood {}".format(self.likelihood(params)))
+        print_likelihood(self)
 
 
 # A minimal GP multi-fidelity class (two levels of fidelity)
 class Multifidelity_GP:
     # Initialize the class
-    def __init__(self, X_L, y_L, X_H, y_H):
+    def __init__(self, X_L, y_L, X_H, y_H, kernel=None):
         self.D = X_H.shape[1]
+        # Covariance function of both levels, isotropic RBF by default.
+        # theta_L and theta_H are [mean, kernel parameters].
+        self.kern = RBF(self.D) if kernel is None else kernel
         self.X_L = X_L
         self.y_L = y_L
         self.X_H = X_H
         self.y_H = y_H
         self.L = np.empty([0,0])
+        # (hyp, X_L, X_H) that self.L was last factored from, None if stale
+        self.factored = None
+        # Posterior products keyed to the (L, y, hyp) they were computed from
+        self.cache = None
+        # Factor of the data augmented with pending points, see fantasy_factor
+        self.fantasy = None
+        # Evaluation count and timing of the last get_max_var call
+        self.acq_stats = None
+        # Gradient backend of train, 'autograd' or 'analytic'
+        self.backend = 'autograd'
 
         self.hyp = self.init_params()
         print("Total number of parameters: %d" % (self.hyp.shape[0]))
 
         self.jitter = 1e-8
+        # Row block size of kernel evaluations, None for a single block
+        self.chunk_size = None
+        # Distance blocks between the model's own arrays (see own_arrays) as
+        # (x, xp, dist), newest last, keyed on the identity of x and xp and
+        # dropped by updt_info. Blocks of test points are never stored.
+        self.dists = []
+        # Byte and entry budgets of self.dists
+        self.dist_bytes = 2 ** 28
+        self.n_dists = 16
+        # Floating point type of the cross-covariances, mean and variance in
+        # predict and pred_var. The factor is always computed in float64;
+        # with np.float32 it is only cast, see cast.
+        self.dtype = np.float64
+        # Copies of the last factors cast to dtype, see cast
+        self.casts = []
 
     # Initialize hyper-parameters
     def init_params(self):
-        hyp = np.ones(self.D + 1)
+        hyp = np.ones(1 + self.kern.n_params)
         hyp[0] = 0
         self.idx_theta_L = np.arange(hyp.shape[0])
 
@@ -176,14 +451,62 @@ class Multifidelity_GP:
         hyp = np.concatenate([hyp, rho, sigma_n])
         return hyp
 
-    # A simple vectorized rbf kernel
+    # Kernel matrix between the rows of x and xp for theta = hyp. Blocks
+    # between the training arrays come from dist, so the likelihood calls of
+    # train only redo the elementwise part; any other block is computed
+    # directly. Inputs larger than chunk_size bypass the cache.
     def kernel(self, x, xp, hyp):
-        output_scale = np.exp(hyp[1])
-        lengthscales = np.exp(hyp[2])
-        # lengthscales = 14.58
-        diffs = np.expand_dims(x / lengthscales, 1) - \
-                np.expand_dims(xp / lengthscales, 0)
-        return output_scale * np.exp(-0.5 * np.sum(diffs ** 2, axis=2))
+        if self.is_own(x, xp):
+            return self.kern.K_dist(self.dist(x, xp), hyp[1:])
+        return self.kern(x, xp, hyp[1:], self.chunk_size)
+
+    # scale * kernel(x, xp, theta_L) + kernel(x, xp, theta_H), with the
+    # distance block computed once for both and not kept past the call.
+    # Kernels without a compact distance block (ARD) are evaluated directly
+    # twice instead, see Kernel.compact_dist.
+    def kernel_sum(self, x, xp, theta_L, theta_H, scale):
+        if self.is_own(x, xp):
+            dist = self.dist(x, xp)
+        elif not self.kern.compact_dist() or (
+                self.chunk_size is not None and x.shape[0] > self.chunk_size):
+            return scale * self.kern(x, xp, theta_L[1:], self.chunk_size) + \
+                   self.kern(x, xp, theta_H[1:], self.chunk_size)
+        else:
+            dist = self.kern.dist(x, xp)
+        return scale * self.kern.K_dist(dist, theta_L[1:]) + \
+               self.kern.K_dist(dist, theta_H[1:])
+
+    # Arrays whose distance blocks may be cached: the training points set by
+    # updt_info. Test points are owned by the caller, who may rewrite them
+    # in place, so their blocks are never cached.
+    def own_arrays(self):
+        return self.X_L, self.X_H
+
+    def is_own(self, x, xp):
+        own = self.own_arrays()
+        return any(x is a for a in own) and any(xp is a for a in own)
+
+    # Hyper-parameter free distance block between two of own_arrays, from
+    # self.dists if it holds one for these very arrays
+    def dist(self, x, xp):
+        dists = self.dists
+        with dist_lock:
+            for i, (x_i, xp_i, dist) in enumerate(dists):
+                if x_i is x and xp_i is xp:
+                    dists.append(dists.pop(i))
+                    return dist
+        dist = self.kern.dist(x, xp)
+        with dist_lock:
+            dists.append((x, xp, dist))
+            while len(dists) > self.n_dists or \
+                    sum(dist_nbytes(entry[2]) for entry in dists) > \
+                    self.dist_bytes:
+                dists.pop(0)
+        return dist
+
+    # Diagonal of kernel(x, x, hyp) as a column vector
+    def kernel_diag(self, x, hyp):
+        return self.kern.diag(x, hyp[1:])
 
     # Computes the negative log-marginal likelihood
     def likelihood(self, hyp):
@@ -220,25 +543,321 @@ class Multifidelity_GP:
         K = np.vstack((np.hstack((K_LL, K_LH)),
                        np.hstack((K_LH.T, K_HH))))
         L = np.linalg.cholesky(K + np.eye(N) * self.jitter)
-        self.L = L
 
-        alpha = np.linalg.solve(np.transpose(L), np.linalg.solve(L, y))
-        NLML = 0.5 * np.matmul(np.transpose(y), alpha) + \
+        Linv_y = solve_triangular(L, y, lower=True)
+        NLML = 0.5 * np.sum(Linv_y ** 2) + \
                np.sum(np.log(np.diag(L))) + 0.5 * np.log(2. * np.pi) * N
-        return NLML[0, 0]
+        return NLML
 
     # Minimizes the negative log-marginal likelihood
-    def train(self):
-        result = minimize(value_and_grad(self.likelihood), self.hyp, jac=True,
-                          method='L-BFGS-B', callback=self.callback)
-        self.hyp = result.x
+    # With n_restarts > 1 the first fit starts from the current hyp and the
+    # others from a Latin hypercube of width 2 * spread around it, run on
+    # n_jobs processes. The fit with the lowest NLML is kept; per-restart
+    # timing and convergence stats are returned and kept in train_stats.
+    # backend='analytic' uses likelihood_and_grad instead of autograd where
+    # it applies, see analytic_grad.
+    def train(self, n_restarts=1, n_jobs=1, spread=2.0, backend='autograd'):
+        self.backend = backend
+        starts = [np.array(self.hyp)]
+        if n_restarts > 1:
+            H = self.hyp.shape[0]
+            offsets = spread * (2. * lhs(H, n_restarts - 1) - 1.)
+            starts += [self.hyp + offset for offset in offsets]
+
+        if n_restarts == 1:
+            stats = [train_restart(self, starts[0], callback=True)]
+        elif n_jobs == 1:
+            stats = [train_restart(self, hyp0) for hyp0 in starts]
+        else:
+            pool = Pool(n_jobs)
+            try:
+                stats = pool.starmap(train_restart,
+                                     [(self, hyp0) for hyp0 in starts])
+            finally:
+                pool.close()
+                pool.join()
+
+        best = min(stats, key=lambda stat: stat['nlml'])
+        self.hyp = best['hyp']
+        self.train_stats = stats
+        self.updt_info(self.X_L, self.y_L, self.X_H, self.y_H)
+        return stats
+
+    # Warm-started refit between sampling rounds: at most max_iters L-BFGS-B
+    # iterations from the current hyp, cut short after time_budget_s
+    # seconds. The best hyp seen is kept if it lowers the NLML, and the
+    # factor is rebuilt only in that case. Returns the NLML before and
+    # after, the evaluation count and the time spent.
+    def retrain(self, max_iters=10, time_budget_s=None, backend='analytic'):
+        start = time.time()
+        hyp0 = np.array(self.hyp)
+        self.backend = backend
+        best = {'hyp': hyp0, 'nlml': np.inf, 'nfev': 0}
+
+        def objective(hyp):
+            if best['nfev'] > 0 and time_budget_s is not None and \
+                    time.time() - start > time_budget_s:
+                raise BudgetExceeded()
+            nlml, grad = self.objective(hyp)
+            best['nfev'] += 1
+            if best['nfev'] == 1:
+                best['nlml0'] = nlml
+            if nlml < best['nlml']:
+                best['hyp'], best['nlml'] = np.array(hyp), nlml
+            return nlml, grad
+
+        if self.X_L.shape[0] + self.X_H.shape[0] > 0:
+            try:
+                minimize(objective, hyp0, jac=True, method='L-BFGS-B',
+                         options={'maxiter': max_iters})
+            except (BudgetExceeded, np.linalg.LinAlgError):
+                pass
+
+        nlml0 = best.get('nlml0', best['nlml'])
+        if best['nlml'] < nlml0:
+            self.hyp = best['hyp']
+            self.updt_info(self.X_L, self.y_L, self.X_H, self.y_H)
+        return {'nlml0': nlml0, 'nlml': min(best['nlml'], nlml0),
+                'nfev': best['nfev'], 'time': time.time() - start}
+
+    # Negative log-marginal likelihood and its gradient. The value is kept
+    # for the callback so it does not have to evaluate the likelihood again.
+    # Where K is not positive definite or overflows the NLML is infinite,
+    # so the line search backs off instead of aborting the fit.
+    def objective(self, hyp):
+        try:
+            if self.backend == 'analytic' and self.analytic_grad():
+                nlml, grad = self.likelihood_and_grad(hyp)
+            else:
+                nlml, grad = value_and_grad(self.likelihood)(hyp)
+        except (np.linalg.LinAlgError, ValueError):
+            nlml = np.inf
+        if not np.isfinite(nlml):
+            nlml, grad = np.inf, np.zeros(hyp.shape[0])
+        self.last_nlml = nlml
+        return nlml, grad
+
+    # True if likelihood_and_grad covers the model, which it does for the
+    # exact model with an isotropic RBF kernel; otherwise the analytic
+    # backend falls back to autograd
+    def analytic_grad(self):
+        return type(self.kern) is RBF and not self.kern.ard
+
+    # Negative log-marginal likelihood and its closed-form gradient. The
+    # kernel parameters get 0.5 tr((K^-1 - alpha alpha^T) dK/dtheta), with
+    # every dK/dtheta built from the same distance and kernel blocks.
+    def likelihood_and_grad(self, hyp):
+        rho = np.exp(hyp[-3])
+        sigma_n_L = np.exp(hyp[-2])
+        sigma_n_H = np.exp(hyp[-1])
+        idx_L = self.idx_theta_L
+        idx_H = self.idx_theta_H
+        theta_L = hyp[idx_L]
+        theta_H = hyp[idx_H]
+        mean_L = theta_L[0]
+        mean_H = rho * mean_L + theta_H[0]
+
+        NL = self.X_L.shape[0]
+        NH = self.X_H.shape[0]
+        N = NL + NH
+        y = np.vstack((self.y_L - mean_L, self.y_H - mean_H))
+
+        # Low fidelity part of K over all points, high fidelity part over
+        # the high fidelity points
+        dist_LH = self.dist(self.X_L, self.X_H)
+        dist_H = self.dist(self.X_H, self.X_H)
+        dist = np.vstack((np.hstack((self.dist(self.X_L, self.X_L), dist_LH)),
+                          np.hstack((dist_LH.T, dist_H))))
+        scale = np.concatenate([np.ones(NL), rho * np.ones(NH)])
+        C_L = np.exp(theta_L[1]) * np.exp(-0.5 * dist / np.exp(theta_L[2]) ** 2)
+        K_L = C_L * np.outer(scale, scale)
+        K_H = np.exp(theta_H[1]) * \
+              np.exp(-0.5 * dist_H / np.exp(theta_H[2]) ** 2)
+        noise = np.concatenate([sigma_n_L * np.ones(NL),
+                                sigma_n_H * np.ones(NH)])
+
+        # Reuse the factor of the current data when hyp is the one it was
+        # built for, as on the first step of a warm-started retrain
+        factored = self.factored
+        if factored is not None and np.array_equal(factored[0], hyp) and \
+                np.array_equal(factored[1], self.X_L) and \
+                np.array_equal(factored[2], self.X_H):
+            L = self.L
+        else:
+            K = np.array(K_L)
+            K[NL:, NL:] += K_H
+            K[np.diag_indices(N)] += noise + self.jitter
+            L = np.linalg.cholesky(K)
+
+        alpha = cho_solve((L, True), y)
+        NLML = 0.5 * np.sum(y * alpha) + np.sum(np.log(np.diag(L))) + \
+               0.5 * np.log(2. * np.pi) * N
+
+        W = cho_solve((L, True), np.eye(N)) - np.matmul(alpha, alpha.T)
+        W_H = W[NL:, NL:]
+        alpha_L = np.sum(alpha[:NL])
+        alpha_H = np.sum(alpha[NL:])
+
+        grad = np.zeros(hyp.shape[0])
+        grad[idx_L[0]] = -(alpha_L + rho * alpha_H)
+        grad[idx_L[1]] = 0.5 * np.sum(W * K_L)
+        grad[idx_L[2]] = 0.5 * np.sum(W * K_L * dist) / \
+                         np.exp(theta_L[2]) ** 2
+        grad[idx_H[0]] = -alpha_H
+        grad[idx_H[1]] = 0.5 * np.sum(W_H * K_H)
+        grad[idx_H[2]] = 0.5 * np.sum(W_H * K_H * dist_H) / \
+                         np.exp(theta_H[2]) ** 2
+        grad[-3] = np.sum(W[:NL, NL:] * K_L[:NL, NL:]) + \
+                   np.sum(W_H * K_L[NL:, NL:]) - rho * mean_L * alpha_H
+        grad[-2] = 0.5 * sigma_n_L * np.trace(W[:NL, :NL])
+        grad[-1] = 0.5 * sigma_n_H * np.trace(W_H)
+        return NLML, grad
+
+    # Joint (low, high) fidelity covariance between two sets of points,
+    # without noise
+    def covariance(self, X_L1, X_H1, X_L2, X_H2, hyp):
+        rho = np.exp(hyp[-3])
+        theta_L = hyp[self.idx_theta_L]
+        theta_H = hyp[self.idx_theta_H]
 
-    def updt_info(self, X_L_new, y_L_new, X_H_new, y_H_new):
+        K_LL = self.kernel(X_L1, X_L2, theta_L)
+        K_LH = rho * self.kernel(X_L1, X_H2, theta_L)
+        K_HL = rho * self.kernel(X_H1, X_L2, theta_L)
+        K_HH = self.kernel_sum(X_H1, X_H2, theta_L, theta_H, rho ** 2)
+        return np.vstack((np.hstack((K_LL, K_LH)),
+                          np.hstack((K_HL, K_HH))))
+
+    # Updates the training data. When the new data only appends rows to the
+    # data self.L was factored from (under the same hyper-parameters), the
+    # factor is extended in place of a full refactorization.
+    def updt_info(self, X_L_new, y_L_new, X_H_new, y_H_new, incremental=True):
         self.X_L = X_L_new
         self.y_L = y_L_new
         self.X_H = X_H_new
         self.y_H = y_H_new
-
+        self.dists = []
+
+        factored = self.factored
+        if incremental and factored is not None and \
+                np.array_equal(factored[0], self.hyp) and \
+                is_appended(factored[1], X_L_new) and \
+                is_appended(factored[2], X_H_new):
+            self.L = self.extend_factor(self.L, factored[1], factored[2],
+                                        X_L_new, X_H_new)
+        else:
+            self.L = self.factor(X_L_new, X_H_new)
+        self.factored = (np.array(self.hyp), np.array(X_L_new),
+                         np.array(X_H_new))
+
+    # Appends rows to the training data; the factor is extended by
+    # updt_info rather than rebuilt
+    def append(self, X_L_add, y_L_add, X_H_add, y_H_add):
+        self.updt_info(np.vstack((self.X_L, X_L_add)),
+                       np.vstack((self.y_L, y_L_add)),
+                       np.vstack((self.X_H, X_H_add)),
+                       np.vstack((self.y_H, y_H_add)))
+
+    # Writes hyp, the data of both fidelities and the arrays of snapshot
+    # (the factor L and the posterior products) to path as an uncompressed
+    # .npz, together with the class name the snapshot restores to
+    def save(self, path):
+        numpy.savez(path, version=SNAPSHOT_VERSION, model=type(self).__name__,
+                    kernel=type(self.kern).__name__,
+                    n_params=self.kern.n_params, jitter=self.jitter,
+                    hyp=self.hyp, X_L=self.X_L, y_L=self.y_L, X_H=self.X_H,
+                    y_H=self.y_H, **self.snapshot())
+
+    # The factor and posterior products save writes. A stale factor is
+    # refreshed first, so the snapshot is always predict-ready.
+    def snapshot(self):
+        factored = self.factored
+        if factored is None or not np.array_equal(factored[0], self.hyp) or \
+                not np.array_equal(factored[1], self.X_L) or \
+                not np.array_equal(factored[2], self.X_H):
+            self.updt_info(self.X_L, self.y_L, self.X_H, self.y_H)
+        Linv_y, alpha = self.posterior()
+        return {'L': self.L, 'Linv_y': Linv_y, 'alpha': alpha}
+
+    # Model from a snapshot written by save, ready to predict without
+    # refactoring. With mmap the arrays are memory-mapped from the file
+    # (read-only; updates build new arrays). A model with another kernel
+    # than the default RBF is restored by passing that kernel. The model is
+    # of the class the snapshot was saved from, which must be cls or one of
+    # its subclasses.
+    @classmethod
+    def load(cls, path, mmap=True, kernel=None):
+        arrays = load_npz(path, mmap)
+        version = int(arrays['version'])
+        if version > SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version: %d" % version)
+        name = str(arrays['model']) if 'model' in arrays \
+            else 'Multifidelity_GP'
+        model_cls = {'Multifidelity_GP': Multifidelity_GP,
+                     'Sparse_Multifidelity_GP': Sparse_Multifidelity_GP
+                     }.get(name)
+        if model_cls is None or not issubclass(model_cls, cls):
+            raise ValueError("Snapshot holds a %s, not a %s" %
+                             (name, cls.__name__))
+        model = model_cls.from_snapshot(arrays, kernel)
+        if type(model.kern).__name__ != str(arrays['kernel']) or \
+                model.kern.n_params != int(arrays['n_params']):
+            raise ValueError("Snapshot was saved with a %s kernel of %d "
+                             "parameters" % (arrays['kernel'],
+                                             arrays['n_params']))
+        model.hyp = numpy.array(arrays['hyp'])
+        model.jitter = float(arrays['jitter'])
+        model.restore(arrays)
+        return model
+
+    # Model on the data of a snapshot, before restore
+    @classmethod
+    def from_snapshot(cls, arrays, kernel):
+        return cls(arrays['X_L'], arrays['y_L'], arrays['X_H'],
+                   arrays['y_H'], kernel)
+
+    # Sets the factor and posterior products from the arrays of a snapshot
+    def restore(self, arrays):
+        self.L = arrays['L']
+        self.factored = (np.array(self.hyp), self.X_L, self.X_H)
+        self.cache = {'L': self.L, 'y_L': self.y_L, 'y_H': self.y_H,
+                      'hyp': np.array(self.hyp),
+                      'Linv_y': arrays['Linv_y'], 'alpha': arrays['alpha']}
+
+    # Extends the factor L of (X_L_old, X_H_old) to (X_L, X_H), which must
+    # only append rows to the old points
+    def extend_factor(self, L, X_L_old, X_H_old, X_L, X_H):
+        hyp = self.hyp
+        sigma_n_L = np.exp(hyp[-2])
+        sigma_n_H = np.exp(hyp[-1])
+        D = self.D
+        empty = np.empty([0, D])
+
+        NL = X_L_old.shape[0]
+        NH = X_H_old.shape[0]
+        X_L_add = X_L[NL:]
+        X_H_add = X_H[NH:]
+        kL = X_L_add.shape[0]
+        kH = X_H_add.shape[0]
+
+        # New low fidelity rows go in between the old low and high blocks
+        if kL > 0:
+            K_pre = self.covariance(X_L_add, empty, X_L_old, empty, hyp)
+            K_new = self.covariance(X_L_add, empty, X_L_add, empty, hyp) + \
+                    np.eye(kL) * (sigma_n_L + self.jitter)
+            K_post = self.covariance(empty, X_H_old, X_L_add, empty, hyp)
+            L = chol_insert(L, NL, K_pre, K_new, K_post)
+
+        # New high fidelity rows go at the end
+        if kH > 0:
+            K_pre = self.covariance(empty, X_H_add, X_L, X_H_old, hyp)
+            K_new = self.covariance(empty, X_H_add, empty, X_H_add, hyp) + \
+                    np.eye(kH) * (sigma_n_H + self.jitter)
+            K_post = np.empty([0, kH])
+            L = chol_insert(L, L.shape[0], K_pre, K_new, K_post)
+        return L
+
+    # Factors the full covariance of the training points (X_L, X_H)
+    def factor(self, X_L, X_H):
         hyp = self.hyp
         rho = np.exp(hyp[-3])
         sigma_n_L = np.exp(hyp[-2])
@@ -246,9 +865,6 @@ class Multifidelity_GP:
         theta_L = hyp[self.idx_theta_L]
         theta_H = hyp[self.idx_theta_H]
 
-        X_L = self.X_L
-        X_H = self.X_H
-
         NL = X_L.shape[0]
         NH = X_H.shape[0]
         N = NL + NH
@@ -259,90 +875,828 @@ class Multifidelity_GP:
                self.kernel(X_H, X_H, theta_H) + np.eye(NH) * sigma_n_H
         K = np.vstack((np.hstack((K_LL, K_LH)),
                        np.hstack((K_LH.T, K_HH))))
-        self.L = np.linalg.cholesky(K + np.eye(N) * self.jitter)
-
-    # Return posterior mean and variance at a set of test points
-    def predict(self, X_star):
+        return np.linalg.cholesky(K + np.eye(N) * self.jitter)
+
+    # Returns the whitened targets L^-1 y and alpha = K^-1 y, recomputed only
+    # when the factor, the targets or the hyper-parameters have changed
+    def posterior(self):
+        cache = self.cache
+        if cache is None or cache['L'] is not self.L or \
+                cache['y_L'] is not self.y_L or \
+                cache['y_H'] is not self.y_H or \
+                not np.array_equal(cache['hyp'], self.hyp):
+            hyp = self.hyp
+            rho = np.exp(hyp[-3])
+            mean_L = hyp[self.idx_theta_L][0]
+            mean_H = rho * mean_L + hyp[self.idx_theta_H][0]
+            y = np.vstack((self.y_L - mean_L, self.y_H - mean_H))
+
+            Linv_y = solve_triangular(self.L, y, lower=True)
+            alpha = solve_triangular(self.L.T, Linv_y, lower=False)
+            cache = {'L': self.L, 'y_L': self.y_L, 'y_H': self.y_H,
+                     'hyp': np.array(hyp), 'Linv_y': Linv_y, 'alpha': alpha}
+            self.cache = cache
+        return cache['Linv_y'], cache['alpha']
+
+    # The factor L of the points (X_L, X_H), alpha (or None), those points,
+    # the test points X_star and hyp in self.dtype. The inputs are centered
+    # on the training points first, so that float32 keeps the precision of
+    # the squared distances of pixel coordinates. The cast copies of the
+    # last two factors are kept.
+    def cast(self, L, alpha, X_L, X_H, X_star):
+        dtype = self.dtype
+        for entry in self.casts:
+            if entry['L'] is L and entry['alpha'] is alpha and \
+                    entry['dtype'] == dtype:
+                break
+        else:
+            X = np.vstack((X_L, X_H))
+            offset = np.mean(X, axis=0) if X.shape[0] > 0 \
+                else np.zeros(self.D)
+            entry = {'L': L, 'alpha': alpha, 'dtype': dtype,
+                     'offset': offset, 'L_cast': L.astype(dtype),
+                     'alpha_cast': None if alpha is None
+                     else alpha.astype(dtype),
+                     'X_L': (X_L - offset).astype(dtype),
+                     'X_H': (X_H - offset).astype(dtype)}
+            self.casts = self.casts[-1:] + [entry]
+        return entry['L_cast'], entry['alpha_cast'], entry['X_L'], \
+               entry['X_H'], (X_star - entry['offset']).astype(dtype), \
+               self.hyp.astype(dtype)
+
+    # Posterior mean at X_star and the whitened cross-covariances
+    # v = L^-1 psi^T, with the test points and hyp as they were used (cast
+    # to self.dtype)
+    def whiten(self, X_star):
         hyp = self.hyp
+        X_L = self.X_L
+        X_H = self.X_H
+        L = self.L
+        _, alpha = self.posterior()
+        if self.dtype != np.float64:
+            L, alpha, X_L, X_H, X_star, hyp = self.cast(L, alpha, X_L, X_H,
+                                                        X_star)
+
         theta_L = hyp[self.idx_theta_L]
         theta_H = hyp[self.idx_theta_H]
         rho = np.exp(hyp[-3])
         mean_L = theta_L[0]
         mean_H = rho * mean_L + theta_H[0]
 
+        psi1 = rho * self.kernel(X_star, X_L, theta_L)
+        psi2 = self.kernel_sum(X_star, X_H, theta_L, theta_H, rho ** 2)
+        psi = np.hstack((psi1, psi2))
 
+        pred_u_star = mean_H + np.matmul(psi, alpha)
 
-        X_L = self.X_L
-        y_L = self.y_L - mean_L
-        X_H = self.X_H
-        y_H = self.y_H - mean_H
-        L = self.L
+        v = solve_triangular(L, psi.T, lower=True)
+        return pred_u_star, v, X_star, hyp
 
-        y = np.vstack((y_L, y_H))
+    # Return posterior mean and variance at a set of test points. With
+    # full_cov=False only the marginal variances are computed and returned
+    # as a column vector, without forming the N* x N* covariance. With
+    # n_workers > 1 the test points are sharded, see predict_parallel.
+    def predict(self, X_star, full_cov=True, n_workers=1):
+        if n_workers > 1 and X_star.shape[0] > 0:
+            return self.predict_parallel(X_star, full_cov, n_workers)
 
-        psi1 = rho * self.kernel(X_star, X_L, theta_L)
-        psi2 = rho ** 2 * self.kernel(X_star, X_H, theta_L) + \
-               self.kernel(X_star, X_H, theta_H)
-        psi = np.hstack((psi1, psi2))
+        pred_u_star, v, X_star, hyp = self.whiten(X_star)
+        theta_L = hyp[self.idx_theta_L]
+        theta_H = hyp[self.idx_theta_H]
+        rho = np.exp(hyp[-3])
+        if not full_cov:
+            var_u_star = rho ** 2 * self.kernel_diag(X_star, theta_L) + \
+                         self.kernel_diag(X_star, theta_H) - \
+                         np.sum(v ** 2, axis=0)[:, None]
+            return pred_u_star, var_u_star
 
-        alpha = np.linalg.solve(np.transpose(L), np.linalg.solve(L, y))
-        pred_u_star = mean_H + np.matmul(psi, alpha)
+        var_u_star = self.kernel_sum(X_star, X_star, theta_L, theta_H,
+                                     rho ** 2) - np.matmul(v.T, v)
 
-        beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L, psi.T))
-        var_u_star = rho ** 2 * self.kernel(X_star, X_star, theta_L) + \
-                     self.kernel(X_star, X_star, theta_H) - np.matmul(psi, beta)
+        return pred_u_star, var_u_star
 
+    # predict with the test points split into n_workers shards run on a
+    # thread pool, as the kernel exps and the BLAS calls release the GIL.
+    # A one-row predict first builds the posterior products and casts, so
+    # the shards only read shared state; test point distance blocks are
+    # local to each shard. The BLAS calls see other block shapes than in a
+    # serial call, so the results agree with it to rounding (allclose), not
+    # bit for bit. With full_cov the N* x N* product is formed once from
+    # the whitened shards.
+    def predict_parallel(self, X_star, full_cov, n_workers):
+        self.predict(X_star[:1], full_cov=False)
+        N = X_star.shape[0]
+        size = int(np.ceil(N / n_workers))
+        shards = [X_star[i:i + size] for i in range(0, N, size)]
+        pool = ThreadPool(n_workers)
+        try:
+            if full_cov:
+                parts = pool.map(self.whiten, shards)
+            else:
+                parts = pool.map(lambda X: self.predict(X, full_cov=False),
+                                 shards)
+        finally:
+            pool.close()
+            pool.join()
+
+        pred_u_star = np.vstack([part[0] for part in parts])
+        if not full_cov:
+            return pred_u_star, np.vstack([part[1] for part in parts])
+
+        v = np.hstack([part[1] for part in parts])
+        X_star = np.vstack([part[2] for part in parts])
+        hyp = parts[0][3]
+        theta_L = hyp[self.idx_theta_L]
+        theta_H = hyp[self.idx_theta_H]
+        rho = np.exp(hyp[-3])
+        var_u_star = self.kernel_sum(X_star, X_star, theta_L, theta_H,
+                                     rho ** 2) - np.matmul(v.T, v)
         return pred_u_star, var_u_star
 
-    def pred_var(self, x, X_L_new, X_H_new):
+    # Yields (start, mean, var) over consecutive blocks of chunk_size test
+    # points, with marginal variances only, so memory stays bounded by the
+    # block size rather than the number of test points
+    def predict_iter(self, X_star, chunk_size=4096, n_workers=1):
+        return predict_blocks(self, X_star, chunk_size, n_workers=n_workers)
+
+    # Returns the factor of the training data augmented with the pending
+    # (fantasy) points X_L_new, X_H_new, together with the augmented points.
+    # The factor is built once per planning round from self.L and grown by
+    # chol_insert as points are appended to the pending sets.
+    def fantasy_factor(self, X_L_new, X_H_new):
+        fantasy = self.fantasy
+        if fantasy is not None and fantasy['L_base'] is self.L and \
+                np.array_equal(fantasy['hyp'], self.hyp) and \
+                np.array_equal(fantasy['X_L_new'], X_L_new) and \
+                np.array_equal(fantasy['X_H_new'], X_H_new):
+            return fantasy['L'], fantasy['X_L'], fantasy['X_H']
+
+        X_L = np.vstack((self.X_L, X_L_new))
+        X_H = np.vstack((self.X_H, X_H_new))
+        factored = self.factored
+        if fantasy is not None and fantasy['L_base'] is self.L and \
+                np.array_equal(fantasy['hyp'], self.hyp) and \
+                is_appended(fantasy['X_L_new'], X_L_new) and \
+                is_appended(fantasy['X_H_new'], X_H_new):
+            L = self.extend_factor(fantasy['L'], fantasy['X_L'],
+                                   fantasy['X_H'], X_L, X_H)
+        elif factored is not None and \
+                np.array_equal(factored[0], self.hyp):
+            L = self.extend_factor(self.L, self.X_L, self.X_H, X_L, X_H)
+        else:
+            L = self.factor(X_L, X_H)
+
+        self.fantasy = {'L_base': self.L, 'hyp': np.array(self.hyp),
+                        'X_L_new': np.array(X_L_new),
+                        'X_H_new': np.array(X_H_new),
+                        'L': L, 'X_L': X_L, 'X_H': X_H}
+        return L, X_L, X_H
+
+    # Posterior variance at x once the pending points X_L_new, X_H_new have
+    # been sampled. x may hold a batch of candidates; with full_cov=False
+    # only their marginal variances are returned.
+    def pred_var(self, x, X_L_new, X_H_new, full_cov=True):
         hyp = self.hyp
+        L, X_L, X_H = self.fantasy_factor(X_L_new, X_H_new)
+        if self.dtype != np.float64:
+            L, _, X_L, X_H, x, hyp = self.cast(L, None, X_L, X_H, x)
+
         rho = np.exp(hyp[-3])
+        theta_L = hyp[self.idx_theta_L]
+        theta_H = hyp[self.idx_theta_H]
+
+        psi = self.covariance(np.empty([0, self.D], dtype=x.dtype), x,
+                              X_L, X_H, hyp)
+
+        v = solve_triangular(L, psi.T, lower=True)
+        if not full_cov:
+            return rho ** 2 * self.kernel_diag(x, theta_L) + \
+                   self.kernel_diag(x, theta_H) - \
+                   np.sum(v ** 2, axis=0)[:, None]
+
+        var_u_star = self.kernel_sum(x, x, theta_L, theta_H, rho ** 2) - \
+                     np.matmul(v.T, v)
+        return var_u_star
+
+    #  Prints the negative log-marginal likelihood at each training step
+    def callback(self, params):
+        print_likelihood(self)
+
+    # Gated negative post-fantasy variance at x, see neg_var
+    def get_neg_var(self, x, thrd, c, X_L_new, X_H_new):
+        return neg_var(self, x, thrd, c, (X_L_new, X_H_new))
+
+    # Vectorized get_neg_var over a batch of candidates X (n x D)
+    def get_neg_var_batch(self, X, thrd, c, X_L_new, X_H_new):
+        return neg_var_batch(self, X, thrd, c, (X_L_new, X_H_new))
+
+    # Finds the candidate with the largest post-fantasy variance, see
+    # max_neg_var. Evaluation counts and rates are left in self.acq_stats.
+    def get_max_var(self, Bounds, Thrd, c, X_L_new, X_H_new, method='grid',
+                    n_grid=50, chunk_size=2048, max_points=2500):
+        return max_neg_var(self, Bounds, (Thrd, c, X_L_new, X_H_new),
+                           method, n_grid, chunk_size, max_points)
+
+    # Greedily selects n_points waypoints for a swarm in one call. Each pick
+    # is the point of a grid of n_grid points per dimension (at most
+    # max_points in all, see grid_size) with the largest post-fantasy
+    # variance (gated as in get_neg_var) and is sampled at high fidelity if
+    # that variance is at most sw_pt_L, at low fidelity otherwise. The grid
+    # cross-covariances are whitened once; every pick then updates the grid
+    # variances with a rank-one correction instead of a new solve against
+    # the full factor.
+    # Returns the new low and high fidelity points and the picked variances.
+    def get_max_var_batch(self, Bounds, Thrd, c, n_points, sw_pt_L,
+                          X_L_new=None, X_H_new=None, n_grid=50,
+                          max_points=2500):
+        hyp = self.hyp
+        rho = np.exp(hyp[-3])
+        sigma_n = np.exp(hyp[-2:])
+        theta_L = hyp[self.idx_theta_L]
+        theta_H = hyp[self.idx_theta_H]
+        D = self.D
+        if X_L_new is None:
+            X_L_new = np.empty([0, D])
+        if X_H_new is None:
+            X_H_new = np.empty([0, D])
+
+        n_grid = grid_size(D, n_grid, max_points)
+        axes = [np.linspace(lb, ub, n_grid) for lb, ub in zip(*Bounds)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+        grid = grid.reshape(-1, D)
+
+        mean, var_old = self.predict(grid, full_cov=False)
+        gate = (mean + c * var_old <= Thrd)[:, 0]
+
+        L, X_L, X_H = self.fantasy_factor(X_L_new, X_H_new)
+        psi = self.covariance(np.empty([0, D]), grid, X_L, X_H, hyp)
+        W = solve_triangular(L, psi.T, lower=True)
+        var = rho ** 2 * self.kernel_diag(grid, theta_L)[:, 0] + \
+              self.kernel_diag(grid, theta_H)[:, 0] - np.sum(W ** 2, axis=0)
+
+        # Rows of the extended factor for the picked points, and the picks
+        R = np.empty([0, L.shape[0]])
+        T = np.empty([0, 0])
+        P = np.empty([0, D])
+        hifi = np.empty(0, dtype=bool)
+        W_new = np.empty([0, grid.shape[0]])
+
+        X_L_batch = np.empty([0, D])
+        X_H_batch = np.empty([0, D])
+        max_vars = []
+        for _ in range(n_points):
+            score = np.where(gate, 0., var)
+            best = np.argmax(score)
+            z = grid[best:best + 1]
+            is_hifi = score[best] <= sw_pt_L
+            max_vars.append(score[best])
+            if is_hifi:
+                X_H_batch = np.vstack((X_H_batch, z))
+            else:
+                X_L_batch = np.vstack((X_L_batch, z))
+
+            # Covariances of z with the fantasy set, the earlier picks and
+            # the grid, all at the fidelity z will be sampled at
+            empty = np.empty([0, D])
+            if is_hifi:
+                k_0 = self.covariance(empty, z, X_L, X_H, hyp)
+                k_g = self.covariance(empty, z, empty, grid, hyp)
+                k_zz = rho ** 2 * self.kernel_diag(z, theta_L) + \
+                       self.kernel_diag(z, theta_H) + sigma_n[1]
+            else:
+                k_0 = self.covariance(z, empty, X_L, X_H, hyp)
+                k_g = self.covariance(z, empty, empty, grid, hyp)
+                k_zz = self.kernel_diag(z, theta_L) + sigma_n[0]
+            scale = np.where(hifi, rho, 1.) * (rho if is_hifi else 1.)
+            k_P = scale * self.kernel(z, P, theta_L) + \
+                  (hifi * is_hifi) * self.kernel(z, P, theta_H)
+
+            l_0 = solve_triangular(L, k_0.T, lower=True)[:, 0]
+            l_P = solve_triangular(T, k_P.T - np.matmul(R, l_0[:, None]),
+                                   lower=True)[:, 0]
+            d = np.sqrt(k_zz[0, 0] + self.jitter - np.sum(l_0 ** 2) -
+                        np.sum(l_P ** 2))
+
+            w = (k_g[0] - np.matmul(l_0, W) - np.matmul(l_P, W_new)) / d
+            var = var - w ** 2
+
+            R = np.vstack((R, l_0[None, :]))
+            T = np.vstack((np.hstack((T, np.zeros((T.shape[0], 1)))),
+                           np.hstack((l_P, [d]))[None, :]))
+            P = np.vstack((P, z))
+            hifi = np.append(hifi, is_hifi)
+            W_new = np.vstack((W_new, w[None, :]))
+
+        return X_L_batch, X_H_batch, np.array(max_vars)
+
+
+# A sparse (inducing point) GP multi-fidelity class. Z_L and Z_H are the
+# inducing inputs of the low and high fidelity levels. method='vfe' uses the
+# variational bound of Titsias, method='fitc' the FITC approximation. The
+# data enter only through the M x M statistics K_uf Lambda^-1 K_fu and
+# K_uf Lambda^-1 y, so updates and predictions cost O(N M^2).
+class Sparse_Multifidelity_GP(Multifidelity_GP):
+    # Initialize the class
+    def __init__(self, X_L, y_L, X_H, y_H, Z_L, Z_H, method='vfe',
+                 kernel=None):
+        self.Z_L = Z_L
+        self.Z_H = Z_H
+        self.method = method
+        # Statistics of the data, keyed to the (hyp, X, y) they summarize
+        self.stats = None
+        Multifidelity_GP.__init__(self, X_L, y_L, X_H, y_H, kernel)
+
+    # The inducing points are the model's own too
+    def own_arrays(self):
+        return self.X_L, self.X_H, self.Z_L, self.Z_H
+
+    # The inducing points, method and data statistics save writes. Stale
+    # statistics are refreshed first.
+    def snapshot(self):
+        stats = self.stats
+        if stats is None or not np.array_equal(stats['hyp'], self.hyp) or \
+                not np.array_equal(stats['X_L'], self.X_L) or \
+                not np.array_equal(stats['X_H'], self.X_H) or \
+                not np.array_equal(stats['y_L'], self.y_L) or \
+                not np.array_equal(stats['y_H'], self.y_H):
+            self.updt_info(self.X_L, self.y_L, self.X_H, self.y_H)
+            stats = self.stats
+        return {'Z_L': self.Z_L, 'Z_H': self.Z_H, 'method': self.method,
+                'L_uu': stats['L_uu'], 'S': stats['S'], 'b': stats['b']}
+
+    # Model on the data and inducing points of a snapshot, before restore
+    @classmethod
+    def from_snapshot(cls, arrays, kernel):
+        return cls(arrays['X_L'], arrays['y_L'], arrays['X_H'],
+                   arrays['y_H'], arrays['Z_L'], arrays['Z_H'],
+                   str(arrays['method']), kernel)
+
+    # Sets the data statistics from the arrays of a snapshot
+    def restore(self, arrays):
+        self.stats = {'hyp': np.array(self.hyp), 'L_uu': arrays['L_uu'],
+                      'S': arrays['S'], 'b': arrays['b'], 'X_L': self.X_L,
+                      'X_H': self.X_H, 'y_L': self.y_L, 'y_H': self.y_H}
+        self.L = self.stats['L_uu']
+        self.factored = None
+
+    # Prior variances of the low and high fidelity points as one vector
+    def covariance_diag(self, X_L, X_H, hyp):
+        rho = np.exp(hyp[-3])
+        theta_L = hyp[self.idx_theta_L]
+        theta_H = hyp[self.idx_theta_H]
+        return np.concatenate([self.kernel_diag(X_L, theta_L)[:, 0],
+                               rho ** 2 * self.kernel_diag(X_H, theta_L)[:, 0] +
+                               self.kernel_diag(X_H, theta_H)[:, 0]])
+
+    # Lower Cholesky factor of the inducing point covariance
+    def factor_uu(self, hyp):
+        Z_L = self.Z_L
+        Z_H = self.Z_H
+        M = Z_L.shape[0] + Z_H.shape[0]
+        K_uu = self.covariance(Z_L, Z_H, Z_L, Z_H, hyp)
+        return np.linalg.cholesky(K_uu + np.eye(M) * self.jitter)
+
+    # Whitened cross-covariance V = L_uu^-1 K_uf and the per-point noise
+    # Lambda of the rows (X_L, X_H)
+    def project(self, L_uu, X_L, X_H, hyp):
         sigma_n_L = np.exp(hyp[-2])
         sigma_n_H = np.exp(hyp[-1])
+        K_uf = self.covariance(self.Z_L, self.Z_H, X_L, X_H, hyp)
+        V = solve_triangular(L_uu, K_uf, lower=True)
+        Lam = np.concatenate([sigma_n_L * np.ones(X_L.shape[0]),
+                              sigma_n_H * np.ones(X_H.shape[0])])
+        if self.method == 'fitc':
+            Lam = Lam + self.covariance_diag(X_L, X_H, hyp) - \
+                  np.sum(V ** 2, axis=0)
+        return V, Lam
+
+    # Centered targets of the low and high fidelity rows as one column
+    def centered(self, y_L, y_H, hyp):
+        rho = np.exp(hyp[-3])
+        mean_L = hyp[self.idx_theta_L][0]
+        mean_H = rho * mean_L + hyp[self.idx_theta_H][0]
+        return np.vstack((y_L - mean_L, y_H - mean_H))
+
+    # Computes the negative log-marginal likelihood (VFE: the negative
+    # evidence lower bound)
+    def likelihood(self, hyp):
+        X_L = self.X_L
+        X_H = self.X_H
+        y = self.centered(self.y_L, self.y_H, hyp)
+        N = y.shape[0]
+
+        L_uu = self.factor_uu(hyp)
+        V, Lam = self.project(L_uu, X_L, X_H, hyp)
+        M = V.shape[0]
+
+        A = V / np.sqrt(Lam)
+        L_B = np.linalg.cholesky(np.eye(M) + np.matmul(A, A.T))
+        c = solve_triangular(L_B, np.matmul(A, y / np.sqrt(Lam)[:, None]),
+                             lower=True)
+
+        NLML = np.sum(np.log(np.diag(L_B))) + 0.5 * np.sum(np.log(Lam)) + \
+               0.5 * np.sum(y[:, 0] ** 2 / Lam) - 0.5 * np.sum(c ** 2) + \
+               0.5 * np.log(2. * np.pi) * N
+        if self.method == 'vfe':
+            NLML = NLML + 0.5 * np.sum(
+                (self.covariance_diag(X_L, X_H, hyp) -
+                 np.sum(V ** 2, axis=0)) / Lam)
+        return NLML
+
+    # Updates the training data. The statistics are extended by the
+    # appended rows in O(k M^2) and rebuilt on any other change.
+    def updt_info(self, X_L_new, y_L_new, X_H_new, y_H_new, incremental=True):
+        self.X_L = X_L_new
+        self.y_L = y_L_new
+        self.X_H = X_H_new
+        self.y_H = y_H_new
+        self.dists = []
+
+        hyp = self.hyp
+        stats = self.stats
+        if incremental and stats is not None and \
+                np.array_equal(stats['hyp'], hyp) and \
+                is_appended(stats['X_L'], X_L_new) and \
+                is_appended(stats['X_H'], X_H_new) and \
+                is_appended(stats['y_L'], y_L_new) and \
+                is_appended(stats['y_H'], y_H_new):
+            L_uu = stats['L_uu']
+            NL = stats['X_L'].shape[0]
+            NH = stats['X_H'].shape[0]
+            S, b = stats['S'], stats['b']
+        else:
+            L_uu = self.factor_uu(hyp)
+            NL = NH = 0
+            M = L_uu.shape[0]
+            S, b = np.zeros((M, M)), np.zeros((M, 1))
+
+        V, Lam = self.project(L_uu, X_L_new[NL:], X_H_new[NH:], hyp)
+        y = self.centered(y_L_new[NL:], y_H_new[NH:], hyp)
+        S = S + np.matmul(V / Lam, V.T)
+        b = b + np.matmul(V / Lam, y)
+
+        self.stats = {'hyp': np.array(hyp), 'L_uu': L_uu, 'S': S, 'b': b,
+                      'X_L': np.array(X_L_new), 'X_H': np.array(X_H_new),
+                      'y_L': np.array(y_L_new), 'y_H': np.array(y_H_new)}
+        self.L = L_uu
+        self.factored = None
+
+    # Returns L_uu, the factor L_B of I + V Lambda^-1 V^T and
+    # L_B^-1 V Lambda^-1 y for the current statistics
+    def posterior(self):
+        stats = self.stats
+        cache = self.cache
+        if cache is None or cache['stats'] is not stats:
+            M = stats['S'].shape[0]
+            L_B = np.linalg.cholesky(np.eye(M) + stats['S'])
+            c = solve_triangular(L_B, stats['b'], lower=True)
+            cache = {'stats': stats, 'L_B': L_B, 'c': c}
+            self.cache = cache
+        return stats['L_uu'], cache['L_B'], cache['c']
+
+    # Posterior mean and variance from whitened inducing covariances
+    def sparse_predict(self, L_uu, L_B, c, X_star, full_cov):
+        hyp = self.hyp
+        rho = np.exp(hyp[-3])
         theta_L = hyp[self.idx_theta_L]
         theta_H = hyp[self.idx_theta_H]
+        mean_H = rho * theta_L[0] + theta_H[0]
+
+        K_us = self.covariance(self.Z_L, self.Z_H, np.empty([0, self.D]),
+                               X_star, hyp)
+        v1 = solve_triangular(L_uu, K_us, lower=True)
+        v2 = solve_triangular(L_B, v1, lower=True)
+        pred_u_star = mean_H + np.matmul(v2.T, c)
+
+        if not full_cov:
+            var_u_star = rho ** 2 * self.kernel_diag(X_star, theta_L) + \
+                         self.kernel_diag(X_star, theta_H) - \
+                         np.sum(v1 ** 2, axis=0)[:, None] + \
+                         np.sum(v2 ** 2, axis=0)[:, None]
+            return pred_u_star, var_u_star
+
+        var_u_star = self.kernel_sum(X_star, X_star, theta_L, theta_H,
+                                     rho ** 2) - \
+                     np.matmul(v1.T, v1) + np.matmul(v2.T, v2)
+        return pred_u_star, var_u_star
 
-        X_L = np.vstack((self.X_L, X_L_new))
-        X_H = np.vstack((self.X_H, X_H_new))
+    # Return posterior mean and variance at a set of test points. Only the
+    # marginal variances are sharded over n_workers threads.
+    def predict(self, X_star, full_cov=True, n_workers=1):
+        if n_workers > 1 and not full_cov:
+            return self.predict_parallel(X_star, full_cov, n_workers)
+        L_uu, L_B, c = self.posterior()
+        return self.sparse_predict(L_uu, L_B, c, X_star, full_cov)
+
+    # Posterior variance at x once the pending points X_L_new, X_H_new have
+    # been sampled, from the statistics augmented with the pending rows
+    def pred_var(self, x, X_L_new, X_H_new, full_cov=True):
+        stats = self.stats
+        fantasy = self.fantasy
+        if fantasy is None or fantasy['stats'] is not stats or \
+                not np.array_equal(fantasy['X_L_new'], X_L_new) or \
+                not np.array_equal(fantasy['X_H_new'], X_H_new):
+            V, Lam = self.project(stats['L_uu'], X_L_new, X_H_new, self.hyp)
+            M = V.shape[0]
+            L_B = np.linalg.cholesky(np.eye(M) + stats['S'] +
+                                     np.matmul(V / Lam, V.T))
+            fantasy = {'stats': stats, 'L_B': L_B,
+                       'X_L_new': np.array(X_L_new),
+                       'X_H_new': np.array(X_H_new)}
+            self.fantasy = fantasy
+        c = np.zeros((fantasy['L_B'].shape[0], 1))
+        _, var_u_star = self.sparse_predict(stats['L_uu'], fantasy['L_B'],
+                                            c, x, full_cov)
+        return var_u_star
 
-        NL = X_L.shape[0]
-        NH = X_H.shape[0]
-        N = NL+NH
+    # The analytic gradient covers the exact model only
+    def analytic_grad(self):
+        return False
+
+    # Greedy waypoint selection as in Multifidelity_GP.get_max_var_batch.
+    # The M x M statistics are cheap to extend, so every pick recomputes
+    # the grid variances by pred_var with the picks so far pending.
+    def get_max_var_batch(self, Bounds, Thrd, c, n_points, sw_pt_L,
+                          X_L_new=None, X_H_new=None, n_grid=50,
+                          max_points=2500):
+        D = self.D
+        if X_L_new is None:
+            X_L_new = np.empty([0, D])
+        if X_H_new is None:
+            X_H_new = np.empty([0, D])
+
+        n_grid = grid_size(D, n_grid, max_points)
+        axes = [np.linspace(lb, ub, n_grid) for lb, ub in zip(*Bounds)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+        grid = grid.reshape(-1, D)
+
+        mean, var_old = self.predict(grid, full_cov=False)
+        gate = (mean + c * var_old <= Thrd)[:, 0]
+
+        X_L_batch = np.empty([0, D])
+        X_H_batch = np.empty([0, D])
+        max_vars = []
+        for _ in range(n_points):
+            var = self.pred_var(grid, np.vstack((X_L_new, X_L_batch)),
+                                np.vstack((X_H_new, X_H_batch)),
+                                full_cov=False)[:, 0]
+            score = np.where(gate, 0., var)
+            best = np.argmax(score)
+            max_vars.append(score[best])
+            if score[best] <= sw_pt_L:
+                X_H_batch = np.vstack((X_H_batch, grid[best:best + 1]))
+            else:
+                X_L_batch = np.vstack((X_L_batch, grid[best:best + 1]))
+        return X_L_batch, X_H_batch, np.array(max_vars)
+
+
+# A recursive multi-level (AR1) GP class, after Le Gratiet and Garnier. X and
+# y are lists of inputs and targets per level, lowest fidelity first. Level t
+# models y_t(x) = rho_t * f_{t-1}(x) + delta_t(x), with f_{t-1} the posterior
+# of level t-1 given its own data, so every level is trained and factored on
+# its own points only, in O(sum N_t^3) rather than O((sum N_t)^3). The
+# recursion matches full co-kriging when the designs are nested.
+class Multilevel_GP:
+    # Initialize the class
+    def __init__(self, X, y, kernel=None):
+        self.n_levels = len(X)
+        self.D = X[-1].shape[1]
+        # Covariance function of every level, isotropic RBF by default
+        self.kern = RBF(self.D) if kernel is None else kernel
+        self.X = list(X)
+        self.y = list(y)
+        # Per level factors, K^-1 (y - mean) and the (hyp, X) factored from
+        self.L = [None] * self.n_levels
+        self.alpha = [None] * self.n_levels
+        self.factored = [None] * self.n_levels
+        # Factors of the data augmented with pending points, see
+        # fantasy_factor
+        self.fantasy = None
+        # Evaluation count and timing of the last get_max_var call
+        self.acq_stats = None
 
-        K_LL = self.kernel(X_L, X_L, theta_L) + np.eye(NL) * sigma_n_L
-        K_LH = rho * self.kernel(X_L, X_H, theta_L)
-        K_HH = rho ** 2 * self.kernel(X_H, X_H, theta_L) + \
-               self.kernel(X_H, X_H, theta_H) + np.eye(NH) * sigma_n_H
-        K = np.vstack((np.hstack((K_LL, K_LH)),
-                       np.hstack((K_LH.T, K_HH))))
+        self.hyp = self.init_params()
+        print("Total number of parameters: %d" % (self.hyp.shape[0]))
+
+        self.jitter = 1e-8
+        # Row block size of kernel evaluations, None for a single block
+        self.chunk_size = None
+
+    # Initialize hyper-parameters. The layout is [theta_0, ..., theta_T,
+    # rho_1, ..., rho_T, sigma_n_0, ..., sigma_n_T], which for two levels is
+    # the layout of Multifidelity_GP.
+    def init_params(self):
+        n = self.n_levels
+        theta = np.ones(1 + self.kern.n_params)
+        theta[0] = 0
+        H = theta.shape[0]
+        hyp = np.concatenate([theta] * n + [np.ones(n - 1),
+                                            0.01 * np.ones(n)])
+        self.idx_theta = [np.arange(t * H, (t + 1) * H) for t in range(n)]
+        self.idx_rho = [None] + [n * H + t - 1 for t in range(1, n)]
+        self.idx_sigma_n = [n * H + n - 1 + t for t in range(n)]
+        # Indices of each level's parameters as [theta, (rho), sigma_n]
+        self.idx_level = [np.concatenate([self.idx_theta[t],
+                                          [self.idx_rho[t]] if t > 0 else [],
+                                          [self.idx_sigma_n[t]]]).astype(int)
+                          for t in range(n)]
+        return hyp
+
+    # Splits the parameters hyp_t of level t into theta, rho and sigma_n
+    def level_params(self, hyp_t, t):
+        H = 1 + self.kern.n_params
+        theta = hyp_t[:H]
+        rho = np.exp(hyp_t[H]) if t > 0 else 1.
+        sigma_n = np.exp(hyp_t[-1])
+        return theta, rho, sigma_n
+
+    # Kernel matrix between the rows of x and xp for theta = hyp
+    def kernel(self, x, xp, hyp):
+        return self.kern(x, xp, hyp[1:], self.chunk_size)
+
+    # Diagonal of kernel(x, x, hyp) as a column vector
+    def kernel_diag(self, x, hyp):
+        return self.kern.diag(x, hyp[1:])
+
+    # Targets of level t less its prior mean and rho_t times the posterior
+    # mean of level t-1, which must be up to date
+    def residual(self, hyp_t, t):
+        theta, rho, _ = self.level_params(hyp_t, t)
+        r = self.y[t] - theta[0]
+        if t > 0:
+            r = r - rho * self.mean(self.X[t], t - 1)
+        return r
+
+    # Computes the negative log-marginal likelihood of level t given the
+    # levels below it. hyp_t holds the parameters of level t only.
+    def likelihood(self, hyp_t, t):
+        theta, _, sigma_n = self.level_params(hyp_t, t)
+        X = self.X[t]
+        y = self.residual(hyp_t, t)
+        N = y.shape[0]
+
+        K = self.kernel(X, X, theta) + np.eye(N) * sigma_n
         L = np.linalg.cholesky(K + np.eye(N) * self.jitter)
 
-        psi1 = rho * self.kernel(x, X_L, theta_L)
-        psi2 = rho ** 2 * self.kernel(x, X_H, theta_L) + \
-               self.kernel(x, X_H, theta_H)
-        psi = np.hstack((psi1, psi2))
+        Linv_y = solve_triangular(L, y, lower=True)
+        NLML = 0.5 * np.sum(Linv_y ** 2) + \
+               np.sum(np.log(np.diag(L))) + 0.5 * np.log(2. * np.pi) * N
+        return NLML
 
-        beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L, psi.T))
-        var_u_star = rho ** 2 * self.kernel(x, x, theta_L) + \
-                     self.kernel(x, x, theta_H) - np.matmul(psi, beta)
-        return var_u_star
+    # Minimizes the negative log-marginal likelihood one level at a time,
+    # from the lowest fidelity up, refactoring each level before the next
+    def train(self):
+        for t in range(self.n_levels):
+            idx = self.idx_level[t]
+            # Level whose parameters objective is fitting
+            self.level = t
+            result = minimize(self.objective, self.hyp[idx], jac=True,
+                              method='L-BFGS-B', callback=self.callback)
+            self.hyp[idx] = result.x
+            self.updt_level(t)
+
+    # Negative log-marginal likelihood of level self.level and its gradient,
+    # infinite where K is not positive definite or overflows
+    def objective(self, hyp_t):
+        try:
+            nlml, grad = value_and_grad(self.likelihood)(hyp_t, self.level)
+        except (np.linalg.LinAlgError, ValueError):
+            nlml = np.inf
+        if not np.isfinite(nlml):
+            nlml, grad = np.inf, np.zeros(hyp_t.shape[0])
+        self.last_nlml = nlml
+        return nlml, grad
+
+    # Updates the training data of every level. A level whose points only
+    # gained rows under the same hyper-parameters has its factor extended;
+    # its targets are always re-solved, as the levels below may have moved.
+    def updt_info(self, X_new, y_new, incremental=True):
+        self.X = list(X_new)
+        self.y = list(y_new)
+        for t in range(self.n_levels):
+            self.updt_level(t, incremental)
+
+    # Refactors level t for its current points and re-solves its targets
+    def updt_level(self, t, incremental=True):
+        hyp_t = self.hyp[self.idx_level[t]]
+        X = self.X[t]
+        factored = self.factored[t]
+        if incremental and factored is not None and \
+                np.array_equal(factored[0], hyp_t) and \
+                is_appended(factored[1], X):
+            L = self.extend_factor(t, self.L[t], factored[1], X)
+        else:
+            L = self.extend_factor(t, np.empty([0, 0]), X[:0], X)
+        self.L[t] = L
+        self.factored[t] = (np.array(hyp_t), np.array(X))
+        self.alpha[t] = cho_solve((L, True), self.residual(hyp_t, t))
+
+    # Appends rows to the training data of each level, given as lists
+    def append(self, X_add, y_add):
+        self.updt_info([np.vstack((X, X_a)) for X, X_a in zip(self.X, X_add)],
+                       [np.vstack((y, y_a)) for y, y_a in zip(self.y, y_add)])
+
+    # Extends the factor L of level t from the points X_old to X, which must
+    # only append rows to X_old
+    def extend_factor(self, t, L, X_old, X):
+        theta, _, sigma_n = self.level_params(self.hyp[self.idx_level[t]], t)
+        X_add = X[X_old.shape[0]:]
+        k = X_add.shape[0]
+        if k == 0:
+            return L
+        K_pre = self.kernel(X_add, X_old, theta)
+        K_new = self.kernel(X_add, X_add, theta) + \
+                np.eye(k) * (sigma_n + self.jitter)
+        return chol_insert(L, L.shape[0], K_pre, K_new, np.empty([0, k]))
+
+    # Posterior mean of level t (the top level by default) at X_star
+    def mean(self, X_star, t=None):
+        t = self.n_levels - 1 if t is None else t
+        mean = 0.
+        for s in range(t + 1):
+            theta, rho, _ = self.level_params(self.hyp[self.idx_level[s]], s)
+            psi = self.kernel(X_star, self.X[s], theta)
+            mean = rho * mean + theta[0] + np.matmul(psi, self.alpha[s])
+        return mean
+
+    # Posterior variance of the top level at X_star from the per level
+    # factors L of the points X, as rho_t^2 var_{t-1} + var(delta_t)
+    def variance(self, X_star, L, X, full_cov):
+        var = 0.
+        for t in range(self.n_levels):
+            theta, rho, _ = self.level_params(self.hyp[self.idx_level[t]], t)
+            psi = self.kernel(X_star, X[t], theta)
+            v = solve_triangular(L[t], psi.T, lower=True)
+            if full_cov:
+                var_t = self.kernel(X_star, X_star, theta) - np.matmul(v.T, v)
+            else:
+                var_t = self.kernel_diag(X_star, theta) - \
+                        np.sum(v ** 2, axis=0)[:, None]
+            var = rho ** 2 * var + var_t
+        return var
+
+    # Return posterior mean and variance at a set of test points. With
+    # full_cov=False only the marginal variances are computed and returned
+    # as a column vector, without forming the N* x N* covariance.
+    def predict(self, X_star, full_cov=True):
+        return self.mean(X_star), \
+               self.variance(X_star, self.L, self.X, full_cov)
+
+    # Yields (start, mean, var) over consecutive blocks of chunk_size test
+    # points, with marginal variances only
+    def predict_iter(self, X_star, chunk_size=4096):
+        return predict_blocks(self, X_star, chunk_size)
+
+    # Returns the per level factors of the training data augmented with the
+    # pending points X_new (one array per level, missing levels are empty),
+    # together with the augmented points. Each level is grown by chol_insert
+    # from the factor of the previous call or from self.L.
+    def fantasy_factor(self, X_new):
+        n = self.n_levels
+        X_new = list(X_new) + [np.empty([0, self.D])] * (n - len(X_new))
+        fantasy = self.fantasy
+        if fantasy is None or \
+                any(L_f is not L for L_f, L in zip(fantasy['L_base'],
+                                                   self.L)) or \
+                not np.array_equal(fantasy['hyp'], self.hyp):
+            fantasy = {'L_base': list(self.L), 'hyp': np.array(self.hyp),
+                       'X_new': [X[:0] for X in self.X],
+                       'L': list(self.L), 'X': list(self.X)}
+
+        for t in range(n):
+            if np.array_equal(fantasy['X_new'][t], X_new[t]):
+                continue
+            if is_appended(fantasy['X_new'][t], X_new[t]):
+                L, X_old = fantasy['L'][t], fantasy['X'][t]
+            else:
+                L, X_old = self.L[t], self.X[t]
+            X = np.vstack((self.X[t], X_new[t]))
+            fantasy['L'][t] = self.extend_factor(t, L, X_old, X)
+            fantasy['X'][t] = X
+            fantasy['X_new'][t] = np.array(X_new[t])
+        self.fantasy = fantasy
+        return fantasy['L'], fantasy['X']
+
+    # Posterior variance at x once the pending points X_new (one array per
+    # level) have been sampled
+    def pred_var(self, x, *X_new, **kwargs):
+        L, X = self.fantasy_factor(X_new)
+        return self.variance(x, L, X, kwargs.get('full_cov', True))
 
     #  Prints the negative log-marginal likelihood at each training step
     def callback(self, params):
-        print("Log likelihood {}".format(self.likelihood(params)))
+        print_likelihood(self)
 
-    def get_neg_var(self, x, thrd, c, X_L_new, X_H_new):
-        x = x[None, :]
-        mean, var_old = self.predict(x)
-        if mean + c * var_old <= thrd:
-            return 0
-        # elif mean - c * var_old >= thrd:
-        #     return 0
-        else:
-            var = self.pred_var(x, X_L_new, X_H_new)
-            return -var
+    # Gated negative post-fantasy variance at x, see neg_var
+    def get_neg_var(self, x, thrd, c, *X_new):
+        return neg_var(self, x, thrd, c, X_new)
+
+    # Vectorized get_neg_var over a batch of candidates X (n x D)
+    def get_neg_var_batch(self, X, thrd, c, *X_new):
+        return neg_var_batch(self, X, thrd, c, X_new)
 
-    def get_max_var(self, Bounds, Thrd, c, X_L_new, X_H_new):
-        Bounds = ([Bounds[0][0], Bounds[1][0]], [Bounds[0][1], Bounds[1][1]])
-        result = differential_evolution(self.get_neg_var, Bounds, args=(Thrd, c, X_L_new, X_H_new), init='random')
-        return result.x[None, :], -result.fun
+    # Finds the candidate with the largest post-fantasy variance given the
+    # pending points X_new of each level, see max_neg_var. With two levels
+    # this is called as Multifidelity_GP.get_max_var.
+    def get_max_var(self, Bounds, Thrd, c, *X_new, **kwargs):
+        return max_neg_var(self, Bounds, (Thrd, c) + X_new, **kwargs)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Covariance functions for the GP classes in gaussian_process.
+
+A kernel holds no hyper-parameters itself; it is evaluated on a vector hyp
+of n_params log parameters, so it can be differentiated by autograd. Every
+kernel splits its evaluation into a hyper-parameter free part, dist(x, xp),
+and K_dist(dist, hyp), so a distance block can be computed once and reused
+for every hyp tried by the optimizer. Kernels compose with + and *.
+Evaluation keeps the floating point type of the inputs and hyp.
+"""
+
+from __future__ import division
+import autograd.numpy as np
+
+
+# Squared distances between the rows of x and xp, from the expansion
+# |x|^2 + |x'|^2 - 2 x.x' clamped at zero against rounding
+def sq_dist(x, xp):
+    sq_dist = np.sum(x ** 2, axis=1)[:, None] + \
+              np.sum(xp ** 2, axis=1)[None, :] - 2. * np.matmul(x, xp.T)
+    return np.maximum(sq_dist, 0.)
+
+
+# Memory held by a distance block, which for composite kernels is a tuple
+def dist_nbytes(dist):
+    if isinstance(dist, tuple):
+        return sum(dist_nbytes(d) for d in dist)
+    return dist.nbytes
+
+
+class Kernel(object):
+    # Number of (log) hyper-parameters
+    n_params = 0
+
+    # Hyper-parameter free distance block between the rows of x and xp
+    def dist(self, x, xp):
+        raise NotImplementedError
+
+    # Kernel matrix from a block returned by dist
+    def K_dist(self, dist, hyp):
+        raise NotImplementedError
+
+    # Diagonal of K(x, x) as a column vector
+    def diag(self, x, hyp):
+        raise NotImplementedError
+
+    # True if dist holds one value per kernel entry (per part of a
+    # composite kernel), so evaluating K_dist twice on one block is cheaper
+    # than two direct evaluations
+    def compact_dist(self):
+        return True
+
+    # Kernel matrix computed directly, without a reusable distance block
+    def K(self, x, xp, hyp):
+        return self.K_dist(self.dist(x, xp), hyp)
+
+    # Kernel matrix between the rows of x and xp. With chunk_size the rows
+    # of x are processed in blocks to bound the temporaries.
+    def __call__(self, x, xp, hyp, chunk_size=None):
+        if chunk_size is None or x.shape[0] <= chunk_size:
+            return self.K(x, xp, hyp)
+        return np.concatenate([self.K(x[i:i + chunk_size], xp, hyp)
+                               for i in range(0, x.shape[0], chunk_size)])
+
+    def __add__(self, other):
+        return Sum(self, other)
+
+    def __mul__(self, other):
+        return Product(self, other)
+
+
+# Base of the stationary kernels s * f(r^2), with r^2 the squared distance
+# scaled by one lengthscale (ard=False) or one per input dimension
+# (ard=True). hyp = [log s, log l] or [log s, log l_1, ..., log l_D].
+class Stationary(Kernel):
+    def __init__(self, input_dim, ard=False):
+        self.input_dim = input_dim
+        self.ard = ard
+        self.n_params = 1 + (input_dim if ard else 1)
+
+    # Unscaled squared distances, N x M, or D x N x M per dimension for ARD
+    def dist(self, x, xp):
+        if not self.ard:
+            return sq_dist(x, xp)
+        return np.stack([(x[:, d][:, None] - xp[:, d][None, :]) ** 2
+                         for d in range(self.input_dim)])
+
+    # The per dimension block of ARD is D times the kernel matrix
+    def compact_dist(self):
+        return not self.ard
+
+    # Squared distances scaled by the lengthscales
+    def scaled(self, dist, hyp):
+        if not self.ard:
+            return dist / np.exp(2. * hyp[1])
+        return np.tensordot(np.exp(-2. * hyp[1:]), dist, axes=1)
+
+    def K_dist(self, dist, hyp):
+        return np.exp(hyp[0]) * self.profile(self.scaled(dist, hyp))
+
+    # Scales the inputs rather than the distances, which needs one GEMM and
+    # no D x N x M temporary
+    def K(self, x, xp, hyp):
+        lengthscales = np.exp(hyp[1:])
+        return np.exp(hyp[0]) * self.profile(sq_dist(x / lengthscales,
+                                                     xp / lengthscales))
+
+    def diag(self, x, hyp):
+        return np.exp(hyp[0]) * np.ones((x.shape[0], 1), dtype=x.dtype)
+
+    # Correlation as a function of the scaled squared distance r2
+    def profile(self, r2):
+        raise NotImplementedError
+
+
+# Distance from a squared distance, with a zero gradient at r2 = 0
+def safe_sqrt(r2):
+    return np.sqrt(np.maximum(r2, 1e-36))
+
+
+# Squared exponential kernel
+class RBF(Stationary):
+    def profile(self, r2):
+        return np.exp(-0.5 * r2)
+
+    # Folds the output scale and lengthscale into one pass over dist
+    def K_dist(self, dist, hyp):
+        if self.ard:
+            return np.exp(hyp[0] - 0.5 * self.scaled(dist, hyp))
+        return np.exp(hyp[0] - 0.5 * np.exp(-2. * hyp[1]) * dist)
+
+
+# Matern kernel with nu = 3/2
+class Matern32(Stationary):
+    def profile(self, r2):
+        r = safe_sqrt(3. * r2)
+        return (1. + r) * np.exp(-r)
+
+
+# Matern kernel with nu = 5/2
+class Matern52(Stationary):
+    def profile(self, r2):
+        r = safe_sqrt(5. * r2)
+        return (1. + r + r ** 2 / 3.) * np.exp(-r)
+
+
+# Base of the kernels combining two others; hyp is the parameters of k1
+# followed by those of k2, and the distance block is the pair of theirs
+class Combination(Kernel):
+    def __init__(self, k1, k2):
+        self.k1 = k1
+        self.k2 = k2
+        self.n_params = k1.n_params + k2.n_params
+
+    def dist(self, x, xp):
+        return self.k1.dist(x, xp), self.k2.dist(x, xp)
+
+    def compact_dist(self):
+        return self.k1.compact_dist() and self.k2.compact_dist()
+
+    def split(self, hyp):
+        return hyp[:self.k1.n_params], hyp[self.k1.n_params:]
+
+
+# Sum of two kernels
+class Sum(Combination):
+    def K_dist(self, dist, hyp):
+        hyp1, hyp2 = self.split(hyp)
+        return self.k1.K_dist(dist[0], hyp1) + self.k2.K_dist(dist[1], hyp2)
+
+    def K(self, x, xp, hyp):
+        hyp1, hyp2 = self.split(hyp)
+        return self.k1.K(x, xp, hyp1) + self.k2.K(x, xp, hyp2)
+
+    def diag(self, x, hyp):
+        hyp1, hyp2 = self.split(hyp)
+        return self.k1.diag(x, hyp1) + self.k2.diag(x, hyp2)
+
+
+# Product of two kernels
+class Product(Combination):
+    def K_dist(self, dist, hyp):
+        hyp1, hyp2 = self.split(hyp)
+        return self.k1.K_dist(dist[0], hyp1) * self.k2.K_dist(dist[1], hyp2)
+
+    def K(self, x, xp, hyp):
+        hyp1, hyp2 = self.split(hyp)
+        return self.k1.K(x, xp, hyp1) * self.k2.K(x, xp, hyp2)
+
+    def diag(self, x, hyp):
+        hyp1, hyp2 = self.split(hyp)
+        return self.k1.diag(x, hyp1) * self.k2.diag(x, hyp2)
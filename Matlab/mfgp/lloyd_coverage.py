@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Density weighted Lloyd iterations on a grid of test points, in place of the
+polygon based Voronoi.LloydsAlgorithmCentroidsNumerically of the MATLAB
+side. A grid point belongs to the Voronoi cell of its nearest robot, so a
+cell is the set of grid points with that robot's label and its centroid is
+the density weighted mean of those points; no cell polygon is clipped or
+integrated. One Lloyd step is a single grid x robots pass. The density is
+typically the normalized MFGP mean from predict_MFGP on the same grid.
+"""
+
+from __future__ import division
+import numpy as np
+
+
+# Scales f to [0, 1] like HILGPC_Data.NormalizeMeans; a constant f gives
+# a uniform density
+def normalize(f):
+    f = np.asarray(f, dtype=float).ravel()
+    span = np.ptp(f)
+    if span == 0.:
+        return np.ones_like(f)
+    return (f - np.min(f)) / span
+
+
+# Index of the nearest of the positions P for every row of X_star. The
+# |x|^2 term of the squared distance is the same for every robot, so only
+# |p|^2 - 2 x.p is compared.
+def assign(P, X_star):
+    P = np.asarray(P, dtype=float)
+    return np.argmin(np.sum(P ** 2, axis=1)[None, :] -
+                     2. * np.matmul(X_star, P.T), axis=1)
+
+
+# Density weighted centroids of the cells of the positions P over the grid
+# X_star with density f. A cell without mass keeps its position. Returns
+# the centroids, the grid labels and the mass of every cell.
+def centroids(P, X_star, f, labels=None):
+    P = np.asarray(P, dtype=float)
+    X_star = np.asarray(X_star, dtype=float)
+    f = np.asarray(f, dtype=float).ravel()
+    if labels is None:
+        labels = assign(P, X_star)
+    n = P.shape[0]
+    mass = np.bincount(labels, weights=f, minlength=n)
+    C = P.copy()
+    has_mass = mass > 0.
+    for d in range(P.shape[1]):
+        moment = np.bincount(labels, weights=f * X_star[:, d], minlength=n)
+        C[has_mass, d] = moment[has_mass] / mass[has_mass]
+    return C, labels, mass
+
+
+# Coverage cost: sum of f |x - p|^2 over the grid, with p the nearest
+# position to x
+def coverage_cost(P, X_star, f, labels=None):
+    P = np.asarray(P, dtype=float)
+    if labels is None:
+        labels = assign(P, X_star)
+    return np.sum(np.ravel(f) * np.sum((X_star - P[labels]) ** 2, axis=1))
+
+
+# Lloyd iterations from the positions P: every step moves each position to
+# the centroid of its cell. Stops after n_iter steps or once no position
+# moves more than tol. Returns the final positions and grid labels.
+def lloyd(P, X_star, f, n_iter=1, tol=0.):
+    P = np.array(P, dtype=float)
+    X_star = np.asarray(X_star, dtype=float)
+    f = np.asarray(f, dtype=float).ravel()
+    labels = assign(P, X_star)
+    for _ in range(n_iter):
+        C, labels, _ = centroids(P, X_star, f, labels)
+        step = np.max(np.sqrt(np.sum((C - P) ** 2, axis=1)))
+        P = C
+        labels = assign(P, X_star)
+        if step <= tol:
+            break
+    return P, labels
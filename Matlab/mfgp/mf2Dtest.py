@@ -18,7 +18,7 @@ from gaussian_process import Multifidelity_GP
 from mpl_toolkits.mplot3d.axes3d import Axes3D
 from scipy.optimize import differential_evolution
 # import seaborn as sns
-# from concorde.tsp import TSPSolver
+from tour import tsp_solve
 from scipy.spatial import distance_matrix
 
 
@@ -41,9 +41,11 @@ class Plot_Search:
         # X_star = np.linspace(lb, ub, nn)
         X_star = numpy.mgrid[bound[0][0]:bound[1][0]:nn, bound[0][1]:bound[1][1]:nn]
         x = numpy.transpose(np.array([np.ravel(X_star[0]), np.ravel(X_star[1])]))
-        z_pred, z_var = model.predict(x)
-        z_pred = np.ravel(z_pred)
-        z_var = np.abs(np.diag(z_var))
+        z_pred = numpy.empty(x.shape[0])
+        z_var = numpy.empty(x.shape[0])
+        for start, pred, var in model.predict_iter(x):
+            z_pred[start:start + pred.shape[0]] = np.ravel(pred)
+            z_var[start:start + var.shape[0]] = np.abs(np.ravel(var))
         x = np.ravel(X_star[0])
         y = np.ravel(X_star[1])
 
@@ -157,9 +159,6 @@ class Plot_Search:
         # plt.pause(0.5)
 
 
-my_plot_search = Plot_Search()
-
-
 def f_H(x):
     noise_H = 0.2
     arg2 = 0.5 * (np.cos(2. * np.pi * x[:, 0]) + np.cos(2. * np.pi * x[:, 1]))
@@ -195,26 +194,13 @@ def train_MFGP(N_H, N_L, Bound):
     return model
 
 
-# def tsp_solve(X):
-#     if X.shape[0] < 4:
-#         return X
-#     else:
-#         lat = pd.Series(X[:, 0])
-#         lon = pd.Series(X[:, 1])
-#         solver = TSPSolver.from_data(lat, lon, norm="EUC_2D")
-#         sort_data = solver.solve()
-#         assert sort_data.success
-#         tour = X[sort_data.tour, :]
-#         # plot_tsp(X)
-#         return tour
-
-
 def plot_tsp(X):
     plt.plot(X[:, 0], X[:, 1], 'ro-')
     plt.show()
 
 
 if __name__ == "__main__":
+    my_plot_search = Plot_Search()
     # number of hi fidelity samples
     N_H = 50
     # number of low fidelity samples
@@ -291,9 +277,9 @@ if __name__ == "__main__":
 
         # fig = plot_mdl(model, Bound, 50, thrd, c, X_L_new, X_H_new)
         plt.pause(1.)
-        # X_L_new = tsp_solve(X_L_new)
+        X_L_new = tsp_solve(X_L_new)
         y_L_new = f_L(X_L_new)
-        # X_H_new = tsp_solve(X_H_new)
+        X_H_new = tsp_solve(X_H_new)
         y_H_new = f_H(X_H_new)
 
         # fig.axes[3].lines[0] = []
@@ -11,21 +11,29 @@ import pandas as pd
 import autograd.numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
-import matlab
 from matplotlib import cm
 import numpy
 from pyDOE import lhs
-from gaussian_process import Multifidelity_GP
+from gaussian_process import Multifidelity_GP, Sparse_Multifidelity_GP
 from mpl_toolkits.mplot3d.axes3d import Axes3D
 from scipy.optimize import differential_evolution
 # import seaborn as sns
-# from concorde.tsp import TSPSolver
+from tour import tsp_solve
+import lloyd_coverage
 from scipy.spatial import distance_matrix
 import sys
+import os
+import weakref
 
 
 # np.random.seed(1234)
 
+# Named float64 arrays shared with matlab or other processes, see
+# alloc_buffer. Values are (array, backing object).
+buffers = {}
+# Models holding views of each named buffer, see update_MFGP_L_buffer
+buffer_models = {}
+
 def init_MFGP():
     X_L = np.empty([0, 2])
     y_L = np.empty([0, 1])
@@ -35,6 +43,19 @@ def init_MFGP():
     model.hyp = numpy.loadtxt('cov_hyp.txt')
     return model
 
+def init_sparse_MFGP(Z_Lmem, Z_Hmem, method='vfe'):
+    # Sparse model for long sessions, Z_L and Z_H are the inducing points
+    # of the low and high fidelity levels (e.g. a coarse grid of the arena)
+    Z_L = np.asarray(Z_Lmem)
+    Z_H = np.asarray(Z_Hmem)
+    X_L = np.empty([0, 2])
+    y_L = np.empty([0, 1])
+    X_H = np.empty([0, 2])
+    y_H = np.empty([0, 1])
+    model = Sparse_Multifidelity_GP(X_L, y_L, X_H, y_H, Z_L, Z_H, method)
+    model.hyp = numpy.loadtxt('cov_hyp.txt')
+    return model
+
 def update_MFGP_L(model, X_Lmem, y_Lmem):
     # Update interface with matlab
     # Convert to numpy from memoryview objects passed by matlab
@@ -67,30 +88,168 @@ def update_MFGP_H(model, X_Hmem, y_Hmem):
     model.updt_info(X_L, y_L, X_H, y_H)
     return model
 
+def append_MFGP_L(model, X_newmem, y_newmem):
+    # Append interface with matlab
+    # Only the new low fidelity rows cross the bridge; the model extends
+    # its factor instead of refactoring the whole history
+    X_new = np.asarray(X_newmem).reshape(-1, model.D)
+    y_new = np.asarray(y_newmem).reshape(-1, 1)
+    model.append(X_new, y_new, np.empty([0, model.D]), np.empty([0, 1]))
+    return model
+
+def append_MFGP_H(model, X_newmem, y_newmem):
+    # Append interface with matlab for new high fidelity rows
+    X_new = np.asarray(X_newmem).reshape(-1, model.D)
+    y_new = np.asarray(y_newmem).reshape(-1, 1)
+    model.append(np.empty([0, model.D]), np.empty([0, 1]), X_new, y_new)
+    return model
+
+def retrain_MFGP(model, max_iters=10, time_budget_s=0.5):
+    # Refit hyperparameters from the current ones between sampling rounds
+    # Bounded in iterations and time so the control loop does not stall
+    model.retrain(max_iters, time_budget_s)
+    return model
+
+def save_MFGP(model, path):
+    # Snapshot interface with matlab
+    # Writes the trained model with its factor, see Multifidelity_GP.save
+    model.save(path)
+    return model
+
+def load_MFGP(path, mmap=True):
+    # Restores a model written by save_MFGP, ready to predict without
+    # retraining or refactoring
+    return Multifidelity_GP.load(path, mmap)
+
 def predict_MFGP(model, X_star):
     # Prediction interface with matlab
 
     # Predict given test points
-    pred_u_star, var_u_star = model.predict(X_star)
+    pred_u_star, var_u_star = model.predict(X_star, full_cov=False)
 
     u = pred_u_star.squeeze()
-    var = np.abs(np.diag(var_u_star.squeeze()))
+    var = np.abs(var_u_star.squeeze())
 
     return [u, var]
 
-# def tsp_solve(X):
-#     if X.shape[0] < 4:
-#         return X
-#     else:
-#         lat = pd.Series(X[:, 0])
-#         lon = pd.Series(X[:, 1])
-#         solver = TSPSolver.from_data(lat, lon, norm="EUC_2D")
-#         sort_data = solver.solve()
-#         assert sort_data.success
-#         tour = X[sort_data.tour, :]
-#         # plot_tsp(X)
-#         return tour
+def predict_MFGP_chunked(model, X_star, chunk_size=4096, mmap_path=None,
+                         out=None, n_workers=1):
+    # Prediction interface with matlab for large grids
+    # Mean and variance are written block by block into preallocated
+    # outputs: out (2 by N) if given, else memory-mapped to mmap_path
+    # (.npy) if given, else a new array. Each block is sharded over
+    # n_workers threads.
+    X_star = np.asarray(X_star)
+    N = X_star.shape[0]
+    if out is not None:
+        pass
+    elif mmap_path is None:
+        out = numpy.empty((2, N))
+    else:
+        out = numpy.lib.format.open_memmap(mmap_path, mode='w+',
+                                           shape=(2, N))
+
+    for start, pred_u_star, var_u_star in model.predict_iter(X_star,
+                                                             chunk_size,
+                                                             n_workers):
+        stop = start + pred_u_star.shape[0]
+        out[0, start:stop] = pred_u_star[:, 0]
+        out[1, start:stop] = np.abs(var_u_star[:, 0])
+
+    return [out[0], out[1]]
+
+def alloc_buffer(name, rows, cols, kind='mmap'):
+    # Create (or attach to) a named rows by cols float64 buffer
+    # kind='mmap': raw row-major file at path name, which matlab maps with
+    #   memmapfile(name, 'Format', {'double', [cols rows], 'x'}, 'Writable', true)
+    #   (matlab sees the transpose)
+    # kind='shm': multiprocessing.shared_memory block called name
+    if kind == 'mmap':
+        mode = 'r+' if os.path.exists(name) else 'w+'
+        array = numpy.memmap(name, dtype='<f8', mode=mode, shape=(rows, cols))
+        backing = array
+    elif kind == 'shm':
+        from multiprocessing import shared_memory
+        try:
+            backing = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            backing = shared_memory.SharedMemory(name=name, create=True,
+                                                 size=8 * rows * cols)
+        array = numpy.ndarray((rows, cols), dtype='<f8', buffer=backing.buf)
+    else:
+        raise ValueError("Unknown buffer kind: %s" % kind)
+    buffers[name] = (array, backing)
+    return name
+
+def free_buffer(name, unlink=False):
+    # Detach from a buffer, removing the shared memory block if unlink
+    # Lifetime: a model updated from a buffer keeps views of it as its
+    # training data. Before the buffer is closed those views are replaced
+    # by copies, so the model stays valid after free_buffer; later updates
+    # from the matlab side need a new update_MFGP_*_buffer call.
+    array, backing = buffers.pop(name)
+    for model in buffer_models.pop(name, ()):
+        detach(model, array)
+    del array
+    if hasattr(backing, 'unlink'):
+        backing.close()
+        if unlink:
+            backing.unlink()
+
+def detach(model, array):
+    # Replace the data of model that lives in array by copies, and drop the
+    # caches that refer to the old views
+    for attr, value in list(vars(model).items()):
+        if isinstance(value, numpy.ndarray) and \
+                numpy.may_share_memory(value, array):
+            setattr(model, attr, numpy.array(value))
+    model.dists = []
+    model.cache = None
+
+def use_buffers(model, *names):
+    # Record that model holds views of the named buffers
+    for name in names:
+        buffer_models.setdefault(name, weakref.WeakSet()).add(model)
+
+def update_MFGP_L_buffer(model, X_name, y_name, n):
+    # Update interface with matlab through shared buffers
+    # The first n rows of the X (n by 2) and y (n by 1) buffers are used
+    # as views, without copies, until the buffers are freed
+    X_L = buffers[X_name][0][:n]
+    y_L = buffers[y_name][0][:n]
+    model.updt_info(X_L, y_L, model.X_H, model.y_H)
+    use_buffers(model, X_name, y_name)
+    return model
+
+def update_MFGP_H_buffer(model, X_name, y_name, n):
+    # Update interface with matlab through shared buffers
+    X_H = buffers[X_name][0][:n]
+    y_H = buffers[y_name][0][:n]
+    model.updt_info(model.X_L, model.y_L, X_H, y_H)
+    use_buffers(model, X_name, y_name)
+    return model
 
+def predict_MFGP_buffer(model, X_star_name, out_name, n, chunk_size=4096,
+                        n_workers=1):
+    # Prediction interface with matlab through shared buffers
+    # Mean and variance for the first n test points are written in place
+    # into rows 0 and 1 of the out buffer (2 by at least n)
+    X_star = buffers[X_star_name][0][:n]
+    out = buffers[out_name][0][:, :n]
+    predict_MFGP_chunked(model, X_star, chunk_size, out=out,
+                         n_workers=n_workers)
+    return n
+
+def coverage_MFGP(model, X_star, positions, n_iter=1, chunk_size=4096):
+    # Coverage interface with matlab
+    # Lloyd steps of the robots at positions (n by 2) over the grid X_star,
+    # with the normalized MFGP mean on the grid as density. Returns the new
+    # positions and the robot label (0 based) of every grid point.
+    X_star = np.asarray(X_star)
+    u, var = predict_MFGP_chunked(model, X_star, chunk_size)
+    P, labels = lloyd_coverage.lloyd(np.asarray(positions), X_star,
+                                     lloyd_coverage.normalize(u), n_iter)
+    return [P, labels]
 
 def plot_tsp(X):
 
@@ -179,9 +338,9 @@ if __name__ == "__main__":
 
         # fig = plot_mdl(model, Bound, 50, thrd, c, X_L_new, X_H_new)
         plt.pause(1.)
-        # X_L_new = tsp_solve(X_L_new)
+        X_L_new = tsp_solve(X_L_new)
         y_L_new = f_L(X_L_new)
-        # X_H_new = tsp_solve(X_H_new)
+        X_H_new = tsp_solve(X_H_new)
         y_H_new = f_H(X_H_new)
 
         # fig.axes[3].lines[0] = []
@@ -0,0 +1,219 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Persistent MFGP worker. Keeps a model from mfgp_matlab resident in its own
+process and serves updates and predictions over a local TCP socket, so the
+MATLAB loop only pays for a socket round trip instead of py.* marshalling.
+
+Framing (all little-endian):
+    request:  opcode (uint8), n_arrays (uint8), arrays
+    response: status (uint8, 0 = ok), n_arrays (uint8), arrays
+    array:    rows (uint32), cols (uint32), rows * cols float64, row-major
+On error the response carries one 1 x n array of the utf-8 message bytes.
+
+Run with: python mfgp_server.py [port]
+"""
+
+from __future__ import division, print_function
+import socket
+import struct
+import sys
+import numpy
+import mfgp_matlab
+
+UPDATE_L = 1
+UPDATE_H = 2
+PREDICT = 3
+GET_HYP = 4
+SET_HYP = 5
+RETRAIN = 6
+APPEND_L = 7
+APPEND_H = 8
+SHUTDOWN = 255
+
+DEFAULT_PORT = 5005
+
+HEADER = struct.Struct('<BB')
+SHAPE = struct.Struct('<II')
+
+
+def recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n > 0:
+        got = sock.recv_into(view, n)
+        if got == 0:
+            raise EOFError("Connection closed")
+        view = view[got:]
+        n -= got
+    return buf
+
+
+def send_frame(sock, code, arrays):
+    parts = [HEADER.pack(code, len(arrays))]
+    for array in arrays:
+        array = numpy.ascontiguousarray(array, dtype='<f8')
+        if array.ndim < 2:
+            array = array.reshape(1, -1)
+        parts.append(SHAPE.pack(array.shape[0], array.shape[1]))
+        parts.append(array.tobytes())
+    sock.sendall(b''.join(parts))
+
+
+def recv_frame(sock):
+    code, n_arrays = HEADER.unpack(recv_exact(sock, HEADER.size))
+    arrays = []
+    for _ in range(n_arrays):
+        rows, cols = SHAPE.unpack(recv_exact(sock, SHAPE.size))
+        data = recv_exact(sock, 8 * rows * cols)
+        arrays.append(numpy.frombuffer(data, dtype='<f8').reshape(rows, cols))
+    return code, arrays
+
+
+def error_array(message):
+    return numpy.frombuffer(message.encode('utf-8'), dtype='u1').astype('f8')
+
+
+def error_message(array):
+    return array.astype('u1').tobytes().decode('utf-8')
+
+
+class MFGPServer:
+    # Initialize the server around a fresh model
+    def __init__(self, port=DEFAULT_PORT, model=None):
+        self.port = port
+        self.model = mfgp_matlab.init_MFGP() if model is None else model
+
+    # Runs one request against the model and returns the response arrays
+    def handle(self, code, arrays):
+        model = self.model
+        if code == UPDATE_L:
+            self.model = mfgp_matlab.update_MFGP_L(model, arrays[0],
+                                                   arrays[1].ravel())
+            return []
+        if code == UPDATE_H:
+            self.model = mfgp_matlab.update_MFGP_H(model, arrays[0],
+                                                   arrays[1].ravel())
+            return []
+        if code == APPEND_L:
+            self.model = mfgp_matlab.append_MFGP_L(model, arrays[0],
+                                                    arrays[1])
+            return []
+        if code == APPEND_H:
+            self.model = mfgp_matlab.append_MFGP_H(model, arrays[0],
+                                                    arrays[1])
+            return []
+        if code == PREDICT:
+            return mfgp_matlab.predict_MFGP_chunked(model, arrays[0])
+        if code == GET_HYP:
+            return [model.hyp]
+        if code == SET_HYP:
+            self.set_hyp(arrays[0].ravel())
+            return []
+        if code == RETRAIN:
+            max_iters, time_budget_s = arrays[0].ravel()
+            stats = model.retrain(int(max_iters), time_budget_s)
+            return [[stats['nlml0'], stats['nlml']]]
+        raise ValueError("Unknown opcode: %d" % code)
+
+    # Refactors the model under new hyper-parameters. A hyp of the wrong
+    # shape is rejected, and if the refactorization fails the model is
+    # left as it was, so later requests still see a valid model.
+    def set_hyp(self, hyp):
+        model = self.model
+        if hyp.shape != model.hyp.shape:
+            raise ValueError("Expected %d hyper-parameters, got %d" %
+                             (model.hyp.shape[0], hyp.shape[0]))
+        if not numpy.all(numpy.isfinite(hyp)):
+            raise ValueError("Hyper-parameters must be finite")
+        saved = dict(vars(model))
+        try:
+            model.hyp = hyp.copy()
+            model.updt_info(model.X_L, model.y_L, model.X_H, model.y_H)
+            if not numpy.all(numpy.isfinite(model.L)):
+                raise ValueError("Covariance is not positive definite "
+                                 "under these hyper-parameters")
+        except Exception:
+            vars(model).clear()
+            vars(model).update(saved)
+            raise
+
+    # Serves one client at a time until a SHUTDOWN request arrives
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(1)
+        print("MFGP server listening on port %d" % self.port)
+        try:
+            while True:
+                sock, _ = listener.accept()
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    while True:
+                        code, arrays = recv_frame(sock)
+                        if code == SHUTDOWN:
+                            send_frame(sock, 0, [])
+                            return
+                        try:
+                            send_frame(sock, 0, self.handle(code, arrays))
+                        except Exception as e:
+                            send_frame(sock, 1, [error_array(repr(e))])
+                except EOFError:
+                    pass
+                finally:
+                    sock.close()
+        finally:
+            listener.close()
+
+
+# Python client with the same calls as the mfgp_matlab interface
+class MFGPClient:
+    # Initialize the class
+    def __init__(self, port=DEFAULT_PORT, host='127.0.0.1'):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, code, *arrays):
+        send_frame(self.sock, code, arrays)
+        status, result = recv_frame(self.sock)
+        if status != 0:
+            raise RuntimeError(error_message(result[0]))
+        return result
+
+    def update_L(self, X_L, y_L):
+        self.request(UPDATE_L, X_L, y_L)
+
+    def update_H(self, X_H, y_H):
+        self.request(UPDATE_H, X_H, y_H)
+
+    def append_L(self, X_new, y_new):
+        self.request(APPEND_L, X_new, y_new)
+
+    def append_H(self, X_new, y_new):
+        self.request(APPEND_H, X_new, y_new)
+
+    def predict(self, X_star):
+        u, var = self.request(PREDICT, X_star)
+        return u.ravel(), var.ravel()
+
+    def get_hyp(self):
+        return self.request(GET_HYP)[0].ravel()
+
+    def set_hyp(self, hyp):
+        self.request(SET_HYP, hyp)
+
+    def retrain(self, max_iters=10, time_budget_s=0.5):
+        return self.request(RETRAIN, [max_iters, time_budget_s])[0].ravel()
+
+    def shutdown(self):
+        self.request(SHUTDOWN)
+        self.sock.close()
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    MFGPServer(port).serve_forever()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Accuracy and speed of the float32 inference mode of Multifidelity_GP
+(model.dtype = numpy.float32) against float64, on the fields in Matlab/Data
+with the hyper-parameters of cov_hyp.txt. Predicts the mean and variance on
+a dense grid over the arena with both types and prints the largest
+differences, relative to the range of the float64 values, and the times.
+
+Run with: python precision_check.py [grid step in pixels]
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import time
+import numpy
+import pandas as pd
+from gaussian_process import Multifidelity_GP
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, '..', 'Data')
+
+# (name, low fidelity files, high fidelity files)
+FIELDS = [('dense lofi + dist7 hifi', ['lofi_train_dense.csv'],
+           ['dist7_hifi.csv']),
+          ('human priors + dist7 hifi',
+           ['prior%d_confidence0.8.csv' % i for i in range(1, 7)],
+           ['dist7_hifi.csv'])]
+
+
+# Points and values of one or more csv files with X, Y and Means columns
+def load(names):
+    data = pd.concat([pd.read_csv(os.path.join(DATA, name))
+                      for name in names])
+    return data[['X', 'Y']].values, data[['Means']].values
+
+
+# Mean and variance over X_star in blocks, and the time it took
+def predict(model, X_star, chunk_size):
+    start = time.time()
+    mean = numpy.empty(X_star.shape[0])
+    var = numpy.empty(X_star.shape[0])
+    for i, pred_u_star, var_u_star in model.predict_iter(X_star, chunk_size):
+        mean[i:i + pred_u_star.shape[0]] = pred_u_star[:, 0]
+        var[i:i + var_u_star.shape[0]] = var_u_star[:, 0]
+    return mean, var, time.time() - start
+
+
+def check(name, X_L, y_L, X_H, y_H, X_star, chunk_size=4096):
+    model = Multifidelity_GP(X_L, y_L, X_H, y_H)
+    model.hyp = numpy.loadtxt(os.path.join(HERE, 'cov_hyp.txt'))
+    model.updt_info(X_L, y_L, X_H, y_H)
+
+    model.dtype = numpy.float64
+    mean64, var64, time64 = predict(model, X_star, chunk_size)
+    model.dtype = numpy.float32
+    predict(model, X_star[:chunk_size], chunk_size)
+    mean32, var32, time32 = predict(model, X_star, chunk_size)
+
+    err_mean = numpy.max(numpy.abs(mean32 - mean64))
+    err_var = numpy.max(numpy.abs(var32 - var64))
+    print("%s: N_L = %d, N_H = %d, %d test points" %
+          (name, X_L.shape[0], X_H.shape[0], X_star.shape[0]))
+    print("  mean: max |f32 - f64| = %.3g (%.3g of range)" %
+          (err_mean, err_mean / numpy.ptp(mean64)))
+    print("  var:  max |f32 - f64| = %.3g (%.3g of range)" %
+          (err_var, err_var / numpy.ptp(var64)))
+    print("  time: float64 %.3f s, float32 %.3f s" % (time64, time32))
+
+
+if __name__ == "__main__":
+    step = float(sys.argv[1]) if len(sys.argv) > 1 else 2.
+    x, y = numpy.meshgrid(numpy.arange(0., 900. + step, step),
+                          numpy.arange(0., 450. + step, step))
+    X_star = numpy.column_stack((x.ravel(), y.ravel()))
+    for name, lofi, hifi in FIELDS:
+        X_L, y_L = load(lofi)
+        X_H, y_H = load(hifi)
+        check(name, X_L, y_L, X_H, y_H, X_star)
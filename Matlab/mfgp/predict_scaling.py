@@ -0,0 +1,60 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Scaling of Multifidelity_GP.predict(X_star, full_cov=False, n_workers=k)
+over k = 1 .. number of cores, on the dense low fidelity field of
+Matlab/Data with the hyper-parameters of cov_hyp.txt. Prints the best of a
+few runs per k, the speedup over k = 1 and the largest difference from the
+serial result, which agrees with it to rounding but not bit for bit.
+
+Run with: OPENBLAS_NUM_THREADS=1 python predict_scaling.py [max workers]
+(single threaded BLAS, so the pool is not competing with BLAS threads)
+"""
+
+from __future__ import division, print_function
+import multiprocessing
+import os
+import sys
+import time
+import numpy
+from gaussian_process import Multifidelity_GP
+from precision_check import HERE, load
+
+REPEATS = 3
+
+
+def best_time(model, X_star, n_workers):
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        result = model.predict(X_star, full_cov=False, n_workers=n_workers)
+        times.append(time.time() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 \
+        else multiprocessing.cpu_count()
+    X_L, y_L = load(['lofi_train_dense.csv'])
+    X_H, y_H = load(['dist7_hifi.csv'])
+    model = Multifidelity_GP(X_L, y_L, X_H, y_H)
+    model.hyp = numpy.loadtxt(os.path.join(HERE, 'cov_hyp.txt'))
+    model.updt_info(X_L, y_L, X_H, y_H)
+
+    x, y = numpy.meshgrid(numpy.arange(0., 900., 4.),
+                          numpy.arange(0., 450., 4.))
+    X_star = numpy.column_stack((x.ravel(), y.ravel()))
+    print("N = %d, %d test points, %d cores" %
+          (X_L.shape[0] + X_H.shape[0], X_star.shape[0],
+           multiprocessing.cpu_count()))
+
+    serial, (mean, var) = best_time(model, X_star, 1)
+    print("workers  time (s)  speedup  max diff  close")
+    for n_workers in range(1, max_workers + 1):
+        elapsed, (mean_k, var_k) = best_time(model, X_star, n_workers)
+        diff = max(numpy.max(numpy.abs(mean - mean_k)),
+                   numpy.max(numpy.abs(var - var_k)))
+        close = numpy.allclose(mean, mean_k) and numpy.allclose(var, var_k)
+        print("%7d  %8.3f  %7.2f  %8.1e  %s" % (n_workers, elapsed,
+                                                serial / elapsed, diff,
+                                                close))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Streams sample logs such as Data/collect_MFGP.csv (X,Y,Sample,RobotId) or
+Data/lofi_train_dense.csv (X,Y,Means) into a Multifidelity_GP. Each csv is
+tailed from a byte offset, so a poll only reads the rows written since the
+last one, a block of chunk_bytes at a time, and a partly written last line
+is left for the next poll. Repeated readings of a location (rounded to
+decimals) are averaged per fidelity: a new location appends a row to the
+model, whose factor is then extended, and a repeated one only changes its
+target. The offsets and the aggregated readings can be saved and restored,
+so a session resumes without re-reading the logs.
+
+Replay with: python sample_feed.py path:L|H [path:L|H ...]
+"""
+
+from __future__ import division, print_function
+import io
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# Columns holding the reading, in order of preference
+VALUE_COLUMNS = ('Sample', 'Means')
+
+
+# Complete rows appended to a csv file since the last read
+class CsvTail:
+    # Initialize the class
+    def __init__(self, path, chunk_bytes=2 ** 20, offset=None):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.offset = offset
+        self.columns = None
+
+    # Yields the new rows as DataFrames of at most about chunk_bytes each.
+    # The offset moves past a block before it is yielded.
+    def chunks(self):
+        with open(self.path, 'rb') as f:
+            if self.columns is None:
+                header = f.readline()
+                if not header.endswith(b'\n'):
+                    return
+                self.columns = header.decode('utf-8').strip().split(',')
+                if self.offset is None:
+                    self.offset = f.tell()
+            f.seek(self.offset)
+            carry = b''
+            while True:
+                block = f.read(self.chunk_bytes)
+                if not block:
+                    return
+                block = carry + block
+                end = block.rfind(b'\n') + 1
+                carry = block[end:]
+                if end == 0:
+                    continue
+                self.offset += end
+                yield pd.read_csv(io.BytesIO(block[:end]), header=None,
+                                  names=self.columns)
+
+
+# Points and readings of a block of rows
+def points_values(frame):
+    value = [c for c in VALUE_COLUMNS if c in frame.columns][0]
+    return frame[['X', 'Y']].values.astype(float), \
+        frame[value].values.astype(float)
+
+
+# Running mean of the readings per location and fidelity, kept in the rows
+# of the model's training data
+class SampleFeed:
+    # Initialize the class around model. The rows it already holds count
+    # as one reading each.
+    def __init__(self, model, decimals=3):
+        self.model = model
+        self.decimals = decimals
+        self.sources = []
+        self.X = {'L': model.X_L, 'H': model.X_H}
+        self.sums = {'L': model.y_L[:, 0].copy(), 'H': model.y_H[:, 0].copy()}
+        self.counts = {'L': np.ones(model.X_L.shape[0]),
+                       'H': np.ones(model.X_H.shape[0])}
+        self.index = {fidelity: self.keys(self.X[fidelity])
+                      for fidelity in ('L', 'H')}
+
+    # Row of every (rounded) location of X
+    def keys(self, X):
+        return {tuple(x): i
+                for i, x in enumerate(np.round(X, self.decimals))}
+
+    # Tails the csv at path as data of the given fidelity ('L' or 'H')
+    def add_source(self, path, fidelity, chunk_bytes=2 ** 20, offset=None):
+        self.sources.append((CsvTail(path, chunk_bytes, offset), fidelity))
+
+    # Reads the rows written to every source since the last poll into the
+    # model. Returns the number of rows read.
+    def poll(self):
+        n_rows = 0
+        for tail, fidelity in self.sources:
+            for frame in tail.chunks():
+                X, y = points_values(frame)
+                self.push(X, y, fidelity)
+                n_rows += X.shape[0]
+        return n_rows
+
+    # Adds readings y at the points X to the given fidelity and updates the
+    # model. Returns the number of new and of repeated locations.
+    def push(self, X, y, fidelity):
+        if X.shape[0] == 0:
+            return 0, 0
+        # Aggregate the block first, then merge it with the earlier readings
+        keys, first, inverse = np.unique(np.round(X, self.decimals), axis=0,
+                                         return_index=True,
+                                         return_inverse=True)
+        inverse = inverse.ravel()
+        sums = np.bincount(inverse, weights=y)
+        counts = np.bincount(inverse).astype(float)
+
+        index = self.index[fidelity]
+        n_old = self.X[fidelity].shape[0]
+        rows = np.array([index.get(tuple(key), -1) for key in keys])
+        seen = rows >= 0
+        new = np.where(~seen)[0]
+        for i, k in enumerate(new):
+            index[tuple(keys[k])] = n_old + i
+
+        self.sums[fidelity][rows[seen]] += sums[seen]
+        self.counts[fidelity][rows[seen]] += counts[seen]
+        self.X[fidelity] = np.vstack((self.X[fidelity], X[first[new]]))
+        self.sums[fidelity] = np.concatenate((self.sums[fidelity],
+                                              sums[new]))
+        self.counts[fidelity] = np.concatenate((self.counts[fidelity],
+                                                counts[new]))
+        self.update_model()
+        return new.shape[0], np.sum(seen)
+
+    # Sets the model data to the current means. Only rows are appended to
+    # X_L and X_H, so updt_info extends the factor rather than rebuilding it.
+    def update_model(self):
+        y = {fidelity: (self.sums[fidelity] / self.counts[fidelity])[:, None]
+             for fidelity in ('L', 'H')}
+        self.model.updt_info(self.X['L'], y['L'], self.X['H'], y['H'])
+
+    # Saves the aggregated readings and the source offsets to path (.npz)
+    def save_state(self, path):
+        np.savez(path, X_L=self.X['L'], sums_L=self.sums['L'],
+                 counts_L=self.counts['L'], X_H=self.X['H'],
+                 sums_H=self.sums['H'], counts_H=self.counts['H'],
+                 paths=np.array([tail.path for tail, _ in self.sources]),
+                 fidelities=np.array([f for _, f in self.sources]),
+                 offsets=np.array([-1 if tail.offset is None else tail.offset
+                                   for tail, _ in self.sources]),
+                 decimals=self.decimals)
+
+    # Restores a state saved by save_state into model, which gets the
+    # aggregated data; polling resumes at the saved offsets
+    @classmethod
+    def load_state(cls, path, model, chunk_bytes=2 ** 20):
+        state = np.load(path)
+        feed = cls(model, int(state['decimals']))
+        for fidelity in ('L', 'H'):
+            feed.X[fidelity] = state['X_' + fidelity]
+            feed.sums[fidelity] = state['sums_' + fidelity]
+            feed.counts[fidelity] = state['counts_' + fidelity]
+            feed.index[fidelity] = feed.keys(feed.X[fidelity])
+        for source, fidelity, offset in zip(state['paths'],
+                                            state['fidelities'],
+                                            state['offsets']):
+            feed.add_source(str(source), str(fidelity), chunk_bytes,
+                            None if offset < 0 else int(offset))
+        feed.update_model()
+        return feed
+
+
+if __name__ == "__main__":
+    from gaussian_process import Multifidelity_GP
+    model = Multifidelity_GP(np.empty([0, 2]), np.empty([0, 1]),
+                             np.empty([0, 2]), np.empty([0, 1]))
+    model.hyp = np.loadtxt(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'cov_hyp.txt'))
+    feed = SampleFeed(model)
+    for arg in sys.argv[1:]:
+        path, fidelity = arg.rsplit(':', 1)
+        feed.add_source(path, fidelity)
+    start = time.time()
+    n_rows = feed.poll()
+    print("%d rows read, %d LF and %d HF locations in %.3f s" %
+          (n_rows, feed.X['L'].shape[0], feed.X['H'].shape[0],
+           time.time() - start))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Tests of Multifidelity_GP. Run with: python -m pytest test_gaussian_process.py
+"""
+
+from __future__ import division
+import numpy as np
+from autograd import value_and_grad
+from gaussian_process import Multifidelity_GP, Sparse_Multifidelity_GP
+
+
+# Model on N_L low and N_H high fidelity points in [-3, 3]^D, with
+# hyper-parameters away from the defaults so every gradient entry matters
+def make_model(N_L, N_H, D, seed=0):
+    rng = np.random.RandomState(seed)
+    X_L = 6. * rng.rand(N_L, D) - 3.
+    X_H = 6. * rng.rand(N_H, D) - 3.
+    y_L = np.sin(X_L[:, :1]) + 0.1 * rng.randn(N_L, 1)
+    y_H = np.cos(X_H[:, :1]) + 0.1 * rng.randn(N_H, 1)
+    model = Multifidelity_GP(X_L, y_L, X_H, y_H)
+    model.hyp = model.hyp + 0.3 * rng.randn(model.hyp.shape[0])
+    return model
+
+
+def check_analytic_grad(model):
+    hyp = np.array(model.hyp)
+    nlml, grad = model.likelihood_and_grad(hyp)
+    nlml_ad, grad_ad = value_and_grad(model.likelihood)(hyp)
+    np.testing.assert_allclose(nlml, nlml_ad, rtol=1e-10)
+    np.testing.assert_allclose(grad, grad_ad, rtol=1e-7, atol=1e-8)
+
+
+def test_analytic_grad_2d():
+    check_analytic_grad(make_model(30, 12, 2))
+
+
+def test_analytic_grad_3d():
+    check_analytic_grad(make_model(30, 12, 3, seed=1))
+
+
+def test_analytic_grad_no_low_fidelity():
+    check_analytic_grad(make_model(0, 15, 2, seed=2))
+
+
+# Appends low and high fidelity rows through updt_info and compares the
+# extended factor with a full rebuild
+def check_incremental(N_L, N_H, k_L, k_H, seed=0):
+    model = make_model(N_L + k_L, N_H + k_H, 2, seed)
+    X_L, y_L = model.X_L, model.y_L
+    X_H, y_H = model.X_H, model.y_H
+    model.updt_info(X_L[:N_L], y_L[:N_L], X_H[:N_H], y_H[:N_H])
+    model.updt_info(X_L, y_L, X_H, y_H)
+    L = model.L
+    model.updt_info(X_L, y_L, X_H, y_H, incremental=False)
+    np.testing.assert_allclose(L, model.L, atol=1e-10)
+
+
+def test_incremental_low_and_high():
+    check_incremental(20, 8, 5, 3)
+
+
+def test_incremental_low_only():
+    check_incremental(20, 8, 4, 0, seed=1)
+
+
+def test_incremental_high_only():
+    check_incremental(20, 8, 0, 4, seed=2)
+
+
+def test_incremental_from_empty():
+    check_incremental(0, 0, 6, 4, seed=3)
+
+
+def test_append_matches_rebuild():
+    model = make_model(20, 8, 2, seed=4)
+    X_L, y_L = model.X_L, model.y_L
+    X_H, y_H = model.X_H, model.y_H
+    model.updt_info(X_L[:15], y_L[:15], X_H[:5], y_H[:5])
+    model.append(X_L[15:], y_L[15:], X_H[5:], y_H[5:])
+    L = model.L
+    model.updt_info(X_L, y_L, X_H, y_H, incremental=False)
+    np.testing.assert_allclose(L, model.L, atol=1e-10)
+
+
+# Sharded predictions agree with a serial call to rounding
+def test_predict_parallel_matches_serial():
+    model = make_model(60, 20, 2, seed=5)
+    model.updt_info(model.X_L, model.y_L, model.X_H, model.y_H,
+                    incremental=False)
+    X_star = 6. * np.random.RandomState(5).rand(131, 2) - 3.
+    for full_cov in (False, True):
+        mean, var = model.predict(X_star, full_cov)
+        for n_workers in (2, 3, 4):
+            mean_k, var_k = model.predict(X_star, full_cov, n_workers)
+            np.testing.assert_allclose(mean_k, mean, rtol=1e-10, atol=1e-12)
+            np.testing.assert_allclose(var_k, var, rtol=1e-10, atol=1e-12)
+
+
+def test_predict_parallel_empty():
+    model = make_model(20, 8, 2, seed=6)
+    model.updt_info(model.X_L, model.y_L, model.X_H, model.y_H,
+                    incremental=False)
+    mean, var = model.predict(np.empty([0, 2]), full_cov=False, n_workers=2)
+    assert mean.shape == (0, 1) and var.shape == (0, 1)
+
+
+# A saved sparse model loads as one, through either class, and predicts as
+# before without rebuilding its statistics
+def test_sparse_snapshot(tmpdir):
+    model = make_model(40, 12, 2, seed=7)
+    sparse = Sparse_Multifidelity_GP(model.X_L, model.y_L, model.X_H,
+                                     model.y_H, model.X_L[:10],
+                                     model.X_H[:5], method='fitc')
+    sparse.hyp = model.hyp
+    path = str(tmpdir.join('sparse.npz'))
+    sparse.save(path)
+    X_star = 6. * np.random.RandomState(7).rand(25, 2) - 3.
+    mean, var = sparse.predict(X_star)
+    for cls in (Multifidelity_GP, Sparse_Multifidelity_GP):
+        loaded = cls.load(path)
+        assert type(loaded) is Sparse_Multifidelity_GP
+        assert loaded.method == 'fitc'
+        mean_l, var_l = loaded.predict(X_star)
+        np.testing.assert_array_equal(mean_l, mean)
+        np.testing.assert_array_equal(var_l, var)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Visiting order for the waypoints picked by get_max_var, in place of the
+Concorde based tsp_solve. A tour is built by nearest neighbour and improved
+by 2-opt and Or-opt moves, each scanned over all candidate positions at once
+with numpy. Paths are open (a robot does not return to where it started)
+unless closed=True. plan_tours splits the low and high fidelity waypoints of
+a round between several robots and orders each robot's share.
+"""
+
+from __future__ import division
+import numpy as np
+from scipy.spatial import distance_matrix
+
+
+# Distance matrix D of m points padded with a zero row and column at index
+# m (= -1), a virtual end point that closes an open path at no cost
+def padded(D):
+    m = D.shape[0]
+    D_ext = np.zeros((m + 1, m + 1))
+    D_ext[:m, :m] = D
+    return D_ext
+
+
+# Length of the path (closed: tour) visiting the points in the given order
+def path_length(D, path, closed=False):
+    path = np.asarray(path)
+    length = np.sum(D[path[:-1], path[1:]])
+    if closed and path.shape[0] > 1:
+        length += D[path[-1], path[0]]
+    return length
+
+
+# Nearest neighbour path through all points of D, from start
+def nearest_neighbour(D, start=0):
+    m = D.shape[0]
+    visited = np.zeros(m, dtype=bool)
+    path = np.empty(m, dtype=int)
+    path[0] = start
+    visited[start] = True
+    for k in range(1, m):
+        dist = np.where(visited, np.inf, D[path[k - 1]])
+        path[k] = np.argmin(dist)
+        visited[path[k]] = True
+    return path
+
+
+# Successor of every position of path; an open path ends at the virtual
+# point -1 of padded(D)
+def successors(path, closed):
+    return np.append(path[1:], path[0] if closed else -1)
+
+
+# Improves path by 2-opt moves until none shortens it. For every edge i the
+# gains of reversing path[i+1:j+1] are computed for all j at once and the
+# best move is applied. path[0] stays in place.
+def two_opt(D, path, closed=False, tol=1e-10):
+    path = np.array(path)
+    m = path.shape[0]
+    if m < 4:
+        return path
+    D_ext = padded(D)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(m - 2):
+            nxt = successors(path, closed)
+            # A closed tour has no move between its first and last edge
+            stop = m - 1 if closed and i == 0 else m
+            j = np.arange(i + 2, stop)
+            if j.shape[0] == 0:
+                continue
+            a, b = path[i], path[i + 1]
+            c, d = path[j], nxt[j]
+            delta = D_ext[a, c] + D_ext[b, d] - D_ext[a, b] - D_ext[c, d]
+            k = np.argmin(delta)
+            if delta[k] < -tol:
+                path[i + 1:j[k] + 1] = path[i + 1:j[k] + 1][::-1]
+                improved = True
+    return path
+
+
+# Improves path by Or-opt moves until none shortens it: segments of 1 to
+# max_len points are moved, possibly reversed, between two other points.
+# For each segment length the gains of all (segment, edge) pairs are
+# computed at once and the best move is applied. path[0] stays in place.
+def or_opt(D, path, closed=False, max_len=3, tol=1e-10):
+    path = np.array(path)
+    m = path.shape[0]
+    D_ext = padded(D)
+    improved = True
+    while improved:
+        improved = False
+        for seg_len in range(1, min(max_len, m - 2) + 1):
+            while True:
+                nxt = successors(path, closed)
+                # Segments path[i:i + seg_len] and the edges (u, w) after
+                # every position k
+                i = np.arange(1, m - seg_len + 1)
+                first, last = path[i], path[i + seg_len - 1]
+                prev, after = path[i - 1], nxt[i + seg_len - 1]
+                removed = D_ext[prev, first] + D_ext[last, after] - \
+                    D_ext[prev, after]
+                u, w = path, nxt
+                forward = D_ext[u[None, :], first[:, None]] + \
+                    D_ext[last[:, None], w[None, :]]
+                backward = D_ext[u[None, :], last[:, None]] + \
+                    D_ext[first[:, None], w[None, :]]
+                delta = np.minimum(forward, backward) - D_ext[u, w][None, :] \
+                    - removed[:, None]
+                # Edges touching the segment are not insertion points
+                k = np.arange(m)[None, :]
+                delta[(k >= i[:, None] - 1) &
+                      (k <= i[:, None] + seg_len - 1)] = np.inf
+                best = np.argmin(delta)
+                s, k = divmod(best, m)
+                if delta[s, k] >= -tol:
+                    break
+                start = i[s]
+                seg = path[start:start + seg_len]
+                if backward[s, k] < forward[s, k]:
+                    seg = seg[::-1]
+                rest = np.concatenate((path[:start], path[start + seg_len:]))
+                k = k if k < start else k - seg_len
+                path = np.concatenate((rest[:k + 1], seg, rest[k + 1:]))
+                improved = True
+    return path
+
+
+# Near-optimal path through the rows of X, from row start (open) or as a
+# closed tour. Returns the order of the rows.
+def solve_tour(X, start=0, closed=False):
+    X = np.asarray(X)
+    if X.shape[0] < 3:
+        return np.arange(X.shape[0])
+    D = distance_matrix(X, X)
+    path = nearest_neighbour(D, start)
+    while True:
+        length = path_length(D, path, closed)
+        path = or_opt(D, two_opt(D, path, closed), closed)
+        if path_length(D, path, closed) >= length - 1e-10:
+            return path
+
+
+# Drop-in for the old Concorde tsp_solve: the rows of X as a closed tour
+def tsp_solve(X):
+    return np.asarray(X)[solve_tour(X, closed=True)]
+
+
+# Assigns every row of X to one of the robots at starts, returning the robot
+# index per row. By default each point goes to the nearest robot; with
+# balanced=True no robot gets more than ceil(n / robots) points, filled by
+# increasing distance.
+def partition(X, starts, balanced=False):
+    D = distance_matrix(X, starts)
+    if not balanced:
+        return np.argmin(D, axis=1)
+    n, k = D.shape
+    capacity = int(np.ceil(n / k))
+    labels = -np.ones(n, dtype=int)
+    load = np.zeros(k, dtype=int)
+    for flat in np.argsort(D, axis=None):
+        point, robot = divmod(flat, k)
+        if labels[point] < 0 and load[robot] < capacity:
+            labels[point] = robot
+            load[robot] += 1
+    return labels
+
+
+# Splits the waypoints of a sampling round between robots at starts and
+# orders each share as a path from the robot's position. Returns per robot
+# the waypoints in visiting order and whether each is high fidelity.
+def plan_tours(starts, X_L_new, X_H_new, balanced=False):
+    starts = np.asarray(starts)
+    X = np.vstack((X_L_new, X_H_new))
+    is_high = np.arange(X.shape[0]) >= X_L_new.shape[0]
+    labels = partition(X, starts, balanced) if X.shape[0] > 0 \
+        else np.empty(0, dtype=int)
+    tours = []
+    for robot in range(starts.shape[0]):
+        idx = np.where(labels == robot)[0]
+        path = solve_tour(np.vstack((starts[robot], X[idx])))
+        idx = idx[path[1:] - 1]
+        tours.append((X[idx], is_high[idx]))
+    return tours